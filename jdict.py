@@ -1,23 +1,322 @@
+import functools
 import gzip
+import heapq
+import itertools
 import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
 
 Result = namedtuple("Result", "query word kanji index info conjugated negative formal conjugation")
 Word = namedtuple("Word", "kanji kana pos gloss")
 Info = namedtuple("Info", "priority info")
 
-class JDict:
+# Binary dictionary layout written by `generate_jdict.py --format binary`:
+#   header: magic "JDCT", version, section count (little-endian u32)
+#   directory: per section a 32 byte name, byte offset and byte size
+#   sections (8 byte aligned):
+#     meta                  JSON with the small tables: conj, pos, infos, rules,
+#                           aux_rules and the name and size of the record file
+#     record_offsets        u32[n+1] byte ranges of the words in the record file
+#     str_to_word.trie      u32 trie of the sorted keys, see below
+#     str_to_word.offsets   u32[n+1] ranges into `str_to_word.values` per key
+#     str_to_word.values    u32 cdata entries (see `_results()`), best score first
+#     str_to_word.scores    u8 priority score of the result of each value
+#     folded.*              same as `str_to_word.*` for the folded keys
+#     fuzzy.keys            concatenated UTF-8 folded keys in sorted order
+#     fuzzy.key_offsets     u32[n+1] byte ranges into `fuzzy.keys`
+#     fuzzy.hashes          u32 sorted CRC-32 of single character deletions of the keys
+#     fuzzy.targets         u32 index of the folded key each hash was deleted from
+#
+# Tries start with the offset of the root node, each node is laid out as
+#   value, #children, child code points (sorted), child node offsets
+# where `value` is the key index + 1 or zero if no key ends at the node.
+#
+# The words live in a separate record file next to the index so that only the
+# index needs to be resident, the file starts with magic "JREC" and version
+# followed by each word as a UTF-8 JSON object like in the JSON format.
+BINARY_MAGIC = b"JDCT"
+# Also the `version` of the JSON format, older JSON files have none
+BINARY_VERSION = 7
+RECORDS_MAGIC = b"JREC"
+RECORDS_HEADER = struct.Struct("<4sI")
+
+def _u32_view(buf):
+    if sys.byteorder == "little":
+        return memoryview(buf).cast("I")
+    arr = array("I", bytes(buf))
+    arr.byteswap()
+    return arr
+
+class _RecordFile:
+    """Read-only sequence of word dicts read on demand from a record file
+
+    Recently used records are kept in a bounded LRU cache."""
+
+    def __init__(self, path, offsets, size, cache_size):
+        self.path = path
+        self.offsets = offsets
+        self.file = None
+        self.pid = None
+
+        with open(path, "rb") as f:
+            magic, version = RECORDS_HEADER.unpack(f.read(RECORDS_HEADER.size))
+            f.seek(0, os.SEEK_END)
+            if magic != RECORDS_MAGIC or version != BINARY_VERSION or f.tell() != size:
+                raise ValueError(f"Record file does not match the dictionary: {path}")
+
+        self.read = functools.lru_cache(maxsize=cache_size)(self.read)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.read(index)
+
+    def read(self, index):
+        # Forked processes would share the file position so each opens its own
+        if self.pid != os.getpid():
+            self.file = open(self.path, "rb")
+            self.pid = os.getpid()
+        begin, end = self.offsets[index], self.offsets[index + 1]
+        self.file.seek(begin)
+        return json.loads(self.file.read(end - begin))
+
+class _MappedTable:
+    """Read-only str -> [int] mapping stored as a trie and offset arrays"""
+
+    def __init__(self, jd, name):
+        self.trie = jd.section(name + ".trie")
+        self.offsets = jd.section(name + ".offsets")
+        self.values = jd.section(name + ".values")
+        self.scores = jd.byte_section(name + ".scores")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def root(self):
+        return self.trie[0]
+
+    def child(self, node, ch):
+        """Return the child of `node` for character `ch` or None if missing"""
+        trie = self.trie
+        num = trie[node + 1]
+        lo = node + 2
+        cp = ord(ch)
+        ix = bisect_left(trie, cp, lo, lo + num)
+        if ix == lo + num or trie[ix] != cp: return None
+        return trie[ix + num]
+
+    def node_entries(self, node):
+        value = self.trie[node]
+        if not value: return []
+        return list(self.values[self.offsets[value - 1]:self.offsets[value]])
+
+    def get(self, query, default=None):
+        node = self.root()
+        for ch in query:
+            node = self.child(node, ch)
+            if node is None: return default
+        return self.node_entries(node) or default
+
+    def scored(self, query):
+        """Iterate `(score, cdata)` of `query` in stored order, best score first"""
+        node = self.root()
+        for ch in query:
+            node = self.child(node, ch)
+            if node is None: return iter(())
+        value = self.trie[node]
+        if not value: return iter(())
+        begin, end = self.offsets[value - 1], self.offsets[value]
+        return zip(self.scores[begin:end], self.values[begin:end])
+
+class _DictTable:
+    """str -> [int] mapping over a JSON `str_to_word` dictionary
+
+    Emulates the trie interface of `_MappedTable` with prefix strings as nodes."""
+
+    def __init__(self, data, score):
+        self.data = data
+        self.score = score
+        self.max_length = max((len(k) for k in data), default=0)
+
+    def __len__(self):
+        return len(self.data)
+
+    def root(self):
+        return ""
+
+    def child(self, node, ch):
+        node += ch
+        return node if len(node) <= self.max_length else None
+
+    def node_entries(self, node):
+        return self.get(node, [])
+
+    def get(self, query, default=None):
+        result = self.data.get(query)
+        if result is None: return default
+        return result if isinstance(result, list) else [result]
+
+    def scored(self, query):
+        return ((self.score(c), c) for c in self.get(query, []))
+
+class _MappedFuzzy:
+    """Single character deletion index of the folded keys stored as sorted hashes"""
+
+    def __init__(self, jd, name):
+        self.mm = jd.mm
+        self.key_base = jd.sections[name + ".keys"][0]
+        self.key_offsets = jd.section(name + ".key_offsets")
+        self.hashes = jd.section(name + ".hashes")
+        self.targets = jd.section(name + ".targets")
+
+    def key(self, index):
+        ofs = self.key_offsets
+        base = self.key_base
+        return str(self.mm[base + ofs[index]:base + ofs[index + 1]], "utf-8")
+
+    def deleted(self, variant):
+        """Keys that may have `variant` as a deletion, hash collisions included"""
+        hashes = self.hashes
+        h = zlib.crc32(variant.encode("utf-8"))
+        ix = bisect_left(hashes, h)
+        while ix < len(hashes) and hashes[ix] == h:
+            yield self.key(self.targets[ix])
+            ix += 1
+
+class _DictFuzzy:
+    """Single character deletion index over a JSON `fuzzy` dictionary"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def deleted(self, variant):
+        return self.data.get(variant, ())
+
+class _MappedDict:
+    """Memory-mapped binary dictionary, pages are shared between processes"""
+
     def __init__(self, path):
-        fn = gzip.open if path.endswith(".gz") else open
-        with fn(path, "rb") as f:
-            self.data = json.load(f)
-            self.words = self.data["words"]
-            self.conjugations = self.data["conj"]
-            self.positions = self.data["pos"]
-            self.infos = [Info(i["priority"], i["info"]) for i in self.data["infos"]]
-            self.str_to_word = self.data["str_to_word"]
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = struct.Struct("<4sII")
+        entry = struct.Struct("<32sII")
+        magic, version, num_sections = header.unpack_from(self.mm, 0)
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"Not a binary dictionary: {path}")
+        if version != BINARY_VERSION:
+            raise ValueError(outdated_dict_message(path, version))
+
+        self.sections = { }
+        for n in range(num_sections):
+            name, offset, size = entry.unpack_from(self.mm, header.size + n * entry.size)
+            self.sections[name.rstrip(b"\0").decode("ascii")] = (offset, size)
+
+        self.meta = json.loads(self.raw_section("meta"))
+
+    def raw_section(self, name):
+        offset, size = self.sections[name]
+        return self.mm[offset:offset + size]
+
+    def section(self, name):
+        offset, size = self.sections[name]
+        return _u32_view(memoryview(self.mm)[offset:offset + size])
+
+    def byte_section(self, name):
+        offset, size = self.sections[name]
+        return memoryview(self.mm)[offset:offset + size]
+
+TRAILING_MARKS = "ー〜"
+
+# cdata entries are packed as
+#   bits  0-17  word index
+#   bit     18  kanji (1) or kana (0) element
+#   bits 19-23  element index
+#   bits 24-27  conjugation, zero if unconjugated
+#   bit     28  formal
+#   bit     29  negative
+#   bit     30  hidden: base form of a conjugatable word, only reachable through
+#               deinflection rules, bits 24-29 hold the part-of-speech class
+ELEMENT_MASK = (1 << 24) - 1
+HIDDEN = 1 << 30
+
+Rule = namedtuple("Rule", "base kana pos_class bits")
+AuxRule = namedtuple("AuxRule", "strip base_conj conjugation negative formal")
+
+def is_kana_base(text):
+    """Same test as `conj.construct()` uses to pick the kana euphonic change"""
+    return text[-2] > 'あ' and text[-2] <= 'ん'
+
+def entry_order(cdata):
+    """Sort key that matches the order `generate_jdict.py` emits conjugations in"""
+    return (cdata & ((1 << 18) - 1), (cdata >> 18) & 1, (cdata >> 19) & 31,
+        (cdata >> 24) & 15, (cdata >> 29) & 1, (cdata >> 28) & 1)
+
+def outdated_dict_message(path, version):
+    return (f"Dictionary {path} has format version {version} but version {BINARY_VERSION} is needed, "
+        "it is from another version of generate_jdict.py: rerun setup_jdict.sh")
+
+def is_binary_dict(path):
+    with open(path, "rb") as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+class JDict:
+    def __init__(self, path, cache_size=65536, record_cache_size=4096):
+        if not path.endswith(".gz") and is_binary_dict(path):
+            self.data = _MappedDict(path)
+            meta = self.data.meta
+            records = os.path.join(os.path.dirname(path), meta["records"])
+            self.words = _RecordFile(records, self.data.section("record_offsets"),
+                meta["records_size"], record_cache_size)
+            self.str_to_word = _MappedTable(self.data, "str_to_word")
+            self.folded = _MappedTable(self.data, "folded")
+            self.fuzzy = _MappedFuzzy(self.data, "fuzzy")
+        else:
+            fn = gzip.open if path.endswith(".gz") else open
+            with fn(path, "rb") as f:
+                self.data = json.load(f)
+                meta = self.data
+                if meta.get("version") != BINARY_VERSION:
+                    raise ValueError(outdated_dict_message(path, meta.get("version")))
+                self.words = self.data["words"]
+                self.str_to_word = _DictTable(self.data["str_to_word"], self._entry_score)
+                self.folded = _DictTable(self.data["folded"], self._entry_score)
+                self.fuzzy = _DictFuzzy(self.data["fuzzy"])
+
+        fold = meta["fold"]
+        self.fold_table = str.maketrans(fold["katakana"], fold["hiragana"], fold["strip"])
+
+        self.conjugations = meta["conj"]
+        self.positions = meta["pos"]
+        self.infos = [Info(i["priority"], i["info"]) for i in meta["infos"]]
+        self.info_scores = meta["info_scores"]
+
+        self.rules = { }
+        for suffix, base, kana, pos_class, cj, neg, fml in meta["rules"]:
+            bits = cj << 24 | fml << 28 | neg << 29
+            self.rules.setdefault(suffix, []).append(Rule(base, kana, pos_class, bits))
+        self.rule_lengths = sorted(set(len(s) for s in self.rules))
+
+        self.aux_rules = { }
+        for suffix, *rule in meta["aux_rules"]:
+            self.aux_rules.setdefault(suffix, []).append(AuxRule(*rule))
+        self.aux_lengths = sorted(set(len(s) for s in self.aux_rules))
+        self.max_aux_strip = max((r.strip for rs in self.aux_rules.values() for r in rs), default=0)
+
+        self._precise_entries = functools.lru_cache(maxsize=cache_size)(self._precise_entries)
+        self.fold = functools.lru_cache(maxsize=64)(self.fold)
+        self._fuzzy_entries = functools.lru_cache(maxsize=cache_size)(self._fuzzy_entries)
+        self.get_word = functools.lru_cache(maxsize=record_cache_size)(self.get_word)
 
     def get_word(self, index):
+        """Return the `Word` at `index`, memoized so the result must not be modified"""
         word = self.words[index]
         return Word(
             { k: self.infos[v] for k,v in word["kanji"] },
@@ -25,11 +324,8 @@ class JDict:
             self.positions[word["pos"]],
             word["gloss"])
 
-    def lookup_precise(self, query):
-        result = self.str_to_word.get(query, [])
-        if not isinstance(result, list):
-            result = [result]
-        for cdata in result:
+    def _results(self, query, entries):
+        for cdata in entries:
             id = (cdata >> 0) & ((1 << 18) - 1)
             kanji = bool((cdata >> 18) & 1)
             index = bool((cdata >> 19) & ((1 << 5) - 1))
@@ -44,31 +340,284 @@ class JDict:
             conjugated = cj != 0
             yield Result(query, word, kanji, index, info, conjugated, neg, fml, conjugation)
 
-    def lookup(self, query):
-        yield from self.lookup_precise(query)
-        if query.endswith("ている"):
-            for q in self.lookup_precise(query[:-2]):
-                yield q._replace(formal=False, conjugation="Progressive")
-        elif query.endswith("てる"):
-            for q in self.lookup_precise(query[:-1]):
-                yield q._replace(formal=False, conjugation="Progressive")
-        elif query.endswith("ています"):
-            for q in self.lookup_precise(query[:-3]):
-                yield q._replace(formal=True, conjugation="Progressive")
-        elif query.endswith("ておく"):
-            for q in self.lookup_precise(query[:-2]):
-                yield q._replace(formal=False, conjugation="Future")
-        elif query.endswith("ておきます"):
-            for q in self.lookup_precise(query[:-4]):
-                yield q._replace(formal=True, conjugation="Future")
-        elif query.endswith("てある"):
-            for q in self.lookup_precise(query[:-2]):
-                yield q._replace(formal=False, conjugation="Finished")
-        elif query.endswith("てあります"):
-            for q in self.lookup_precise(query[:-4]):
-                yield q._replace(formal=True, conjugation="Finished")
-        
+    def _entry_score(self, cdata):
+        """Priority score of the info `_results()` reports for `cdata`"""
+        id = cdata & ((1 << 18) - 1)
+        kind = ["kana", "kanji"][(cdata >> 18) & 1]
+        index = bool((cdata >> 19) & ((1 << 5) - 1))
+        return self.info_scores[self.words[id][kind][index][1]]
+
+    def _conjugated_entries(self, base, rule, entries):
+        """Entries of the conjugated form of `base` according to `rule`"""
+        if len(base) < 2 or is_kana_base(base) != rule.kana: return []
+        return [cdata & ELEMENT_MASK | rule.bits for cdata in entries
+            if cdata & HIDDEN and (cdata >> 24) & 63 == rule.pos_class]
+
+    def fold(self, text):
+        """Return `(folded, offsets)` where `folded` is `text` normalized like the
+        folded index keys and `offsets[i]` is the offset in `folded` of `text[i]`"""
+        table = self.fold_table
+        folded = []
+        offsets = [0]
+        for ch in text:
+            code = table.get(ord(ch), ord(ch))
+            if code is not None and not ch.isspace():
+                folded.append(chr(code))
+            offsets.append(len(folded))
+        return "".join(folded), offsets
+
+    def _precise_entries(self, query, table):
+        """Sorted cdata for `query`, both exact matches and deinflected ones (memoized)"""
+        found = [c for c in table.get(query, []) if not c & HIDDEN]
+        if len(query) > 1:
+            for length in self.rule_lengths:
+                if length > len(query): break
+                stem = query[:len(query) - length]
+                for rule in self.rules.get(query[len(query) - length:], ()):
+                    base = stem + rule.base
+                    found += self._conjugated_entries(base, rule, table.get(base, []))
+        return tuple(sorted(set(found), key=entry_order))
+
+    def _scored_entries(self, query, table):
+        """Like `_precise_entries()` but lazily yields `(-score, order, cdata)` in
+        ascending order, merging the pre-sorted index entries of every base form"""
+        streams = [((-s, entry_order(c), c) for s, c in table.scored(query) if not c & HIDDEN)]
+        if len(query) > 1:
+            for length in self.rule_lengths:
+                if length > len(query): break
+                stem = query[:len(query) - length]
+                for rule in self.rules.get(query[len(query) - length:], ()):
+                    base = stem + rule.base
+                    if len(base) < 2 or is_kana_base(base) != rule.kana: continue
+                    streams.append(self._scored_conjugations(table.scored(base), rule))
+
+        prev = None
+        for entry in heapq.merge(*streams):
+            if entry != prev:
+                yield entry
+            prev = entry
+
+    def _scored_conjugations(self, scored, rule):
+        for score, cdata in scored:
+            if cdata & HIDDEN and (cdata >> 24) & 63 == rule.pos_class:
+                cdata = cdata & ELEMENT_MASK | rule.bits
+                yield -score, entry_order(cdata), cdata
+
+    def _fuzzy_keys(self, query):
+        """Folded index keys within one OCR edit of `query`, exact match first
+
+        An edit is a substitution anywhere or a missing or extra character
+        inside the query. Missing or extra characters at the ends would only
+        move the segment boundaries."""
+
+        table = self.folded
+        fuzzy = self.fuzzy
+        found = { }
+
+        if table.get(query):
+            found[query] = True
+        # Missing character: `query` is an inner deletion of the key
+        for key in fuzzy.deleted(query):
+            if len(key) == len(query) + 1 and any(key[:i] + key[i+1:] == query for i in range(1, len(key) - 1)):
+                found[key] = True
+        for i in range(len(query)):
+            variant = query[:i] + query[i+1:]
+            # Extra character: the key is an inner deletion of `query`
+            if 0 < i < len(query) - 1 and table.get(variant):
+                found[variant] = True
+            # Substitution: both have the same deletion at `i`
+            for key in fuzzy.deleted(variant):
+                if len(key) == len(query) and key[:i] + key[i+1:] == variant:
+                    found[key] = True
+        return list(found)
+
+    def _fuzzy_entries(self, query):
+        """Like `_precise_entries()` for keys within edit distance one of `query` (memoized)
+
+        Returns `(key, cdata)` pairs where `key` is the corrected query. Only the
+        stem of conjugated words is corrected, the conjugation suffix must match."""
+
+        table = self.folded
+        if len(query) < 2: return ()
+
+        found = { query: list(self._precise_entries(query, table)) }
+        for key in self._fuzzy_keys(query):
+            found.setdefault(key, []).extend(c for c in table.get(key, []) if not c & HIDDEN)
+
+        for length in self.rule_lengths:
+            if length >= len(query): break
+            stem = query[:len(query) - length]
+            suffix = query[len(query) - length:]
+            for rule in self.rules.get(suffix, ()):
+                for base in self._fuzzy_keys(stem + rule.base):
+                    if not base.endswith(rule.base): continue
+                    entries = self._conjugated_entries(base, rule, table.get(base, []))
+                    if entries:
+                        key = base[:len(base) - len(rule.base)] + suffix
+                        found.setdefault(key, []).extend(entries)
+
+        return tuple((key, tuple(sorted(set(entries), key=entry_order)))
+            for key, entries in found.items() if entries)
+
+    def _walk(self, text, start, end, table):
+        """Return `{ end: cdata }` like `_precise_entries()` for all prefixes of `text[start:end]`
+
+        Walks the index once along the text, branching to the base form of
+        every deinflection rule whose suffix appears after the current node."""
+
+        found = { }
+        node = table.root()
+        pos = start
+        while True:
+            for length in self.rule_lengths:
+                if pos + length > end: break
+                if pos + length - start <= 1: continue
+                rules = self.rules.get(text[pos:pos + length])
+                if not rules: continue
+                stem = text[start:pos]
+                for rule in rules:
+                    base_node = node
+                    for ch in rule.base:
+                        base_node = table.child(base_node, ch)
+                        if base_node is None: break
+                    else:
+                        entries = self._conjugated_entries(stem + rule.base, rule, table.node_entries(base_node))
+                        if entries:
+                            found.setdefault(pos + length, []).extend(entries)
+
+            if pos >= end: break
+            node = table.child(node, text[pos])
+            pos += 1
+            if node is None: break
+
+            entries = [c for c in table.node_entries(node) if not c & HIDDEN]
+            if entries:
+                found.setdefault(pos, []).extend(entries)
+
+        return { pos: tuple(sorted(set(found[pos]), key=entry_order)) for pos in sorted(found) }
+
+    def _table(self, folded):
+        return self.folded if folded else self.str_to_word
+
+    def lookup_precise(self, query, folded=False):
+        """Look up `query` and its deinflections
+
+        With `folded` the query is normalized with `fold()` and looked up in the
+        folded index so katakana, long vowel marks and whitespace don't matter.
+        The results then have the folded query."""
+        if folded: query = self.fold(query)[0]
+        yield from self._results(query, self._precise_entries(query, self._table(folded)))
+
+    def lookup(self, query, folded=False):
+        """Like `lookup_precise()` but also handles auxiliaries and trailing marks"""
+        if folded: query = self.fold(query)[0]
+        table = self._table(folded)
+        yield from self._lookup(query, lambda q: self._results(q, self._precise_entries(q, table)))
+
+    def lookup_fuzzy(self, query):
+        """Like `lookup(query, folded=True)` but tolerates one wrong, missing or
+        extra character, such as OCR mistaking っ for つ or ー for 一
+
+        The results have the corrected query."""
+        query = self.fold(query)[0]
+        def precise(q):
+            for key, entries in self._fuzzy_entries(q):
+                yield from self._results(key, entries)
+        yield from self._lookup(query, precise)
+
+    def lookup_top(self, query, k, folded=False):
+        """Yield the `k` results of `lookup()` with the highest priority score,
+        best first with ties in `lookup()` order
+
+        The index stores the entries of each key best first so only the
+        returned results are read and nothing else is sorted."""
+
+        if folded: query = self.fold(query)[0]
+        table = self._table(folded)
+        groups = list(self._top_groups(query))
+
+        def group_entries(group_ix, q, aux):
+            for neg_score, order, cdata in self._scored_entries(q, table):
+                cj = (cdata >> 24) & 15
+                if aux and not (cj and self.conjugations[cj] == self.conjugations[aux.base_conj]):
+                    continue
+                yield neg_score, group_ix, order, cdata
+
+        streams = [group_entries(ix, q, aux) for ix, (q, aux) in enumerate(groups)]
+        for _, group_ix, _, cdata in itertools.islice(heapq.merge(*streams), k):
+            q, aux = groups[group_ix]
+            result = next(self._results(q, (cdata,)))
+            if aux:
+                result = result._replace(negative=aux.negative, formal=aux.formal, conjugation=aux.conjugation)
+            yield result
+
+    def _top_groups(self, query):
+        """`(query, aux)` for each `precise()` call of `_lookup()` in order"""
+        yield query, None
+
+        for length in self.aux_lengths:
+            if length > len(query): break
+            for aux in self.aux_rules.get(query[len(query) - length:], ()):
+                yield query[:len(query) - aux.strip], aux
+
+        if query.endswith("ー"):
+            yield from self._top_groups(query[:-1])
+        if query.endswith("〜"):
+            yield from self._top_groups(query[:-1])
+
+    def prefix_matches(self, text, start=0, end=None, folded=False):
+        """Find all `lookup()` matches starting at `text[start]` with one index walk
+
+        Returns a dict of `{ end: [Result] }` in ascending order of `end` where
+        the results are the same as `list(lookup(text[start:end], folded))`.
+        With `folded` the text is folded once and all the ends in `text` that
+        map to a match are included."""
+
+        if end is None: end = len(text)
+        if not folded:
+            return self._prefix_matches(text, start, end, self.str_to_word)
+
+        norm, offsets = self.fold(text)
+        norm_matches = self._prefix_matches(norm, offsets[start], offsets[end], self.folded)
+        # `offsets` is non-decreasing so the ends mapping to a folded end are a range
+        matches = { }
+        for norm_end, results in norm_matches.items():
+            lo = bisect_left(offsets, norm_end, start + 1, end + 1)
+            hi = bisect_right(offsets, norm_end, lo, end + 1)
+            for pos in range(lo, hi):
+                matches[pos] = results
+        return matches
+
+    def _prefix_matches(self, text, start, end, table):
+        entries = self._walk(text, start, end, table)
+
+        def precise(query):
+            return self._results(query, entries.get(start + len(query), ()))
+
+        # Auxiliary and trailing mark rules in `_lookup()` extend past the index matches
+        limit = min(max(entries, default=start) + self.max_aux_strip, end)
+        while limit < end and text[limit] in TRAILING_MARKS:
+            limit += 1
+
+        matches = { }
+        for pos in range(start + 1, limit + 1):
+            results = list(self._lookup(text[start:pos], precise))
+            if results:
+                matches[pos] = results
+        return matches
+
+    def _lookup(self, query, precise):
+        yield from precise(query)
+
+        for length in self.aux_lengths:
+            if length > len(query): break
+            for aux in self.aux_rules.get(query[len(query) - length:], ()):
+                base_conj = self.conjugations[aux.base_conj]
+                for q in precise(query[:len(query) - aux.strip]):
+                    if q.conjugated and q.conjugation == base_conj:
+                        yield q._replace(negative=aux.negative, formal=aux.formal, conjugation=aux.conjugation)
+
         if query.endswith("ー"):
-            yield from self.lookup(query[:-1])
+            yield from self._lookup(query[:-1], precise)
         if query.endswith("〜"):
-            yield from self.lookup(query[:-1])
+            yield from self._lookup(query[:-1], precise)
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+# Benchmark dictionary generation, loading and lookups on a synthetic JMdict
+#
+# A JMdict-shaped XML file with realistic entry counts and shapes is generated
+# and compiled with `generate_jdict.py`. Each dictionary format is then loaded
+# in fresh processes to measure cold load time, lookup throughput on generated
+# Japanese text and peak RSS. The results are written as a JSON report so runs
+# can be compared when the dictionary format changes.
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+gen_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.dirname(gen_dir)
+
+KANA = (
+    "あいうえおかきくけこがぎぐげごさしすせそざじずぜぞたちつてとだでど"
+    "なにぬねのはひふへほばびぶべぼぱぴぷぺぽまみむめもやゆよらりるれろわん")
+KATAKANA = (
+    "アイウエオカキクケコガギグゲゴサシスセソザジズゼゾタチツテトダデド"
+    "ナニヌネノハヒフヘホバビブベボパピプペポマミムメモヤユヨラリルレロワンー")
+SMALL = "ゃゅょっ"
+
+# Kanji and words are picked log-uniformly so that the first ones are common
+KANJI = "".join(chr(c) for c in range(0x4e00, 0x4e00 + 3000))
+
+# (part-of-speech, weight, kana ending of the dictionary form)
+POSITIONS = [
+    ("noun (common) (futsuumeishi)", 50, ""),
+    ("noun or participle which takes the aux. verb suru", 10, ""),
+    ("adjectival nouns or quasi-adjectives (keiyodoshi)", 5, ""),
+    ("expressions (phrases, clauses, etc.)", 5, ""),
+    ("adverb (fukushi)", 3, ""),
+    ("Ichidan verb", 5, "る"),
+    ("Godan verb with 'ku' ending", 2, "く"),
+    ("Godan verb with 'ru' ending", 3, "る"),
+    ("Godan verb with 'su' ending", 2, "す"),
+    ("Godan verb with 'u' ending", 2, "う"),
+    ("Godan verb with 'mu' ending", 1, "む"),
+    ("Godan verb with 'tsu' ending", 1, "つ"),
+    ("Godan verb with 'gu' ending", 1, "ぐ"),
+    ("Godan verb with 'bu' ending", 1, "ぶ"),
+    ("adjective (keiyoushi)", 3, "い"),
+    ("suru verb - included", 2, "する"),
+    ("pronoun", 1, ""),
+    ("interjection (kandoushi)", 1, ""),
+]
+
+PRIORITIES = ["news1", "news2", "ichi1", "ichi2", "spec1", "spec2", "gai1"]
+KANJI_INFOS = ["irregular kanji usage", "rarely-used kanji form", "ateji (phonetic) reading"]
+KANA_INFOS = ["out-dated or obsolete kana usage", "word containing irregular kana usage"]
+WORDS = ["thing", "person", "place", "time", "to go", "to see", "water", "light",
+    "small", "large", "quickly", "book", "to make", "house", "voice", "cold"]
+PARTICLES = ["は", "が", "を", "に", "で", "と", "の", "も", "から", "まで", "よ", "ね"]
+PUNCTUATION = ["。", "、", "！", "？", "…"]
+
+def random_kana(rng, length, chars=KANA):
+    text = ""
+    for _ in range(length):
+        text += rng.choice(chars)
+        if rng.random() < 0.1:
+            text += rng.choice(SMALL)
+    return text
+
+def random_kanji(rng, length):
+    return "".join(KANJI[int(len(KANJI) ** rng.random()) - 1] for _ in range(length))
+
+def random_entry(rng, seq):
+    """Return JMdict XML of a random entry and its `(pos, [headwords])`"""
+
+    pos, _, ending = rng.choices(POSITIONS, weights=[p[1] for p in POSITIONS])[0]
+
+    katakana = not ending and rng.random() < 0.1
+    readings = []
+    kanjis = []
+    if katakana:
+        readings.append(random_kana(rng, rng.randint(2, 6), KATAKANA))
+    else:
+        # Short readings have many homonyms like in JMdict
+        for n in range(1 + (rng.random() < 0.15)):
+            length = rng.choices([1, 2, 3, 4, 5], weights=[1, 30, 35, 24, 10])[0]
+            readings.append(random_kana(rng, length) + ending)
+        num_kanji = rng.choices([0, 1, 2, 3], weights=[20, 65, 12, 3])[0]
+        for _ in range(num_kanji):
+            okurigana = ending and rng.random() < 0.7
+            kanji = random_kanji(rng, rng.randint(1, 2) if okurigana else rng.randint(1, 3))
+            if okurigana and rng.random() < 0.3:
+                kanji += random_kana(rng, 1)
+            kanjis.append(kanji + ending)
+
+    def priorities(tag):
+        pri = ""
+        if rng.random() < 0.15:
+            for p in rng.sample(PRIORITIES, rng.randint(1, 3)):
+                pri += f"<{tag}>{p}</{tag}>"
+            pri += f"<{tag}>nf{rng.randint(1, 48):02d}</{tag}>"
+        return pri
+
+    def infos(tag, options):
+        return f"<{tag}>{rng.choice(options)}</{tag}>" if rng.random() < 0.03 else ""
+
+    # JMdict doesn't repeat elements within an entry
+    kanjis = list(dict.fromkeys(kanjis))
+    readings = list(dict.fromkeys(readings))
+
+    xml = [f"<entry>\n<ent_seq>{seq}</ent_seq>"]
+    for kanji in kanjis:
+        xml.append(f"<k_ele><keb>{kanji}</keb>{infos('ke_inf', KANJI_INFOS)}{priorities('ke_pri')}</k_ele>")
+    for reading in readings:
+        xml.append(f"<r_ele><reb>{reading}</reb>{infos('re_inf', KANA_INFOS)}{priorities('re_pri')}</r_ele>")
+    for sense in range(rng.choices([1, 2, 3, 4], weights=[60, 25, 10, 5])[0]):
+        xml.append("<sense>")
+        if sense == 0:
+            xml.append(f"<pos>{escape(pos)}</pos>")
+        for _ in range(rng.choices([1, 2, 3, 4], weights=[40, 35, 15, 10])[0]):
+            gloss = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+            xml.append(f"<gloss>{gloss}</gloss>")
+        xml.append("</sense>")
+    xml.append("</entry>")
+    return "\n".join(xml), (pos, kanjis + readings)
+
+def generate_jmdict(path, num_entries, seed):
+    """Write a synthetic gzipped JMdict file, returns the `(pos, [headwords])` of each entry"""
+
+    rng = random.Random(seed)
+    entries = []
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<JMdict>\n')
+        for n in range(num_entries):
+            xml, entry = random_entry(rng, 1000000 + n)
+            f.write(xml)
+            f.write("\n")
+            entries.append(entry)
+        f.write("</JMdict>\n")
+    return entries
+
+def generate_queries(entries, num_queries, seed):
+    """Return Japanese words and sentences built from the dictionary entries
+
+    Words are headwords, conjugated forms and misses. Sentences mix them with
+    particles and punctuation like OCR'd speech bubbles."""
+
+    sys.path.insert(0, gen_dir)
+    import generate_jdict
+    generate_jdict.load_conj_tables(os.path.join(gen_dir, "tables"))
+
+    rng = random.Random(seed)
+
+    def pick_entry():
+        return entries[int(len(entries) ** rng.random()) - 1]
+
+    def pick_word():
+        pos, words = pick_entry()
+        word = rng.choice(words)
+        if rng.random() < 0.5:
+            key = generate_jdict.rule_key(word, pos)
+            if key:
+                rules, _, fixed = generate_jdict.ending_rules(*key)
+                if rules:
+                    rule = rng.choice(rules)
+                    word = word[:len(word) - len(rule[1])] + rule[0]
+                else:
+                    # Copula and suru forms follow the whole word (勉強する)
+                    word += rng.choice(fixed)[0]
+        if rng.random() < 0.1:
+            word += random_kana(rng, 1)
+        return word
+
+    words = [pick_word() for _ in range(num_queries)]
+
+    sentences = []
+    for _ in range(num_queries // 8):
+        parts = []
+        for _ in range(rng.randint(2, 8)):
+            parts.append(pick_word())
+            if rng.random() < 0.6:
+                parts.append(rng.choice(PARTICLES))
+        parts.append(rng.choice(PUNCTUATION))
+        sentences.append("".join(parts))
+
+    return { "words": words, "sentences": sentences }
+
+def peak_rss(who=None):
+    if not resource: return None
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss * scale
+
+def run_generate(argv):
+    """Run `generate_jdict.py` in this process and print its peak RSS as JSON"""
+
+    sys.path.insert(0, gen_dir)
+    import generate_jdict
+    sys.argv = [os.path.join(gen_dir, "generate_jdict.py")] + argv
+
+    # Keep stdout for the result
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    begin = time.perf_counter()
+    generate_jdict.main()
+    elapsed = time.perf_counter() - begin
+    sys.stdout = stdout
+
+    print(json.dumps({
+        "seconds": elapsed,
+        "peak_rss": peak_rss(),
+        "peak_rss_workers": peak_rss(resource.RUSAGE_CHILDREN) if resource else None,
+    }))
+
+def throughput(fn, items, min_time):
+    """Return calls per second of `fn` over `items`, repeated for at least `min_time`"""
+    count = 0
+    begin = time.perf_counter()
+    while True:
+        for item in items:
+            fn(item)
+        count += len(items)
+        elapsed = time.perf_counter() - begin
+        if elapsed >= min_time:
+            return count / elapsed
+
+def run_worker(dict_path, queries_path, min_time):
+    """Measure a single dictionary in this process and print the results as JSON"""
+
+    with open(queries_path, "rt", encoding="utf-8") as f:
+        queries = json.load(f)
+
+    rss_before = peak_rss()
+    begin = time.perf_counter()
+    sys.path.insert(0, root_dir)
+    from jdict import JDict
+    jdict = JDict(dict_path)
+    load_time = time.perf_counter() - begin
+    rss_loaded = peak_rss()
+
+    words = queries["words"]
+    sentences = queries["sentences"]
+
+    # The first pass over the queries runs with empty caches
+    begin = time.perf_counter()
+    for word in words:
+        list(jdict.lookup(word))
+    first_pass = len(words) / (time.perf_counter() - begin)
+
+    def prefix_matches(text):
+        for start in range(len(text)):
+            jdict.prefix_matches(text, start, min(start + 10, len(text)))
+
+    result = {
+        "load_seconds": load_time,
+        "first_lookup_per_second": first_pass,
+        "lookup_precise_per_second": throughput(lambda q: list(jdict.lookup_precise(q)), words, min_time),
+        "lookup_per_second": throughput(lambda q: list(jdict.lookup(q)), words, min_time),
+        "prefix_matches_chars_per_second": throughput(prefix_matches, sentences, min_time) * sum(map(len, sentences)) / len(sentences),
+        "matched_words": sum(1 for w in words if any(True for _ in jdict.lookup(w))),
+        "num_words": len(jdict.words),
+        "peak_rss_start": rss_before,
+        "peak_rss_loaded": rss_loaded,
+        "peak_rss": peak_rss(),
+    }
+    print(json.dumps(result))
+
+def summarize(runs):
+    """Median of every numeric field over the runs"""
+    summary = { }
+    for key in runs[0]:
+        values = sorted(r[key] for r in runs if r[key] is not None)
+        summary[key] = values[len(values) // 2] if values else None
+    return summary
+
+def file_sizes(path):
+    directory, name = os.path.split(path)
+    base = os.path.splitext(name)[0]
+    return { f: os.path.getsize(os.path.join(directory, f)) for f in sorted(os.listdir(directory))
+        if os.path.splitext(f)[0] == base }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark jdict on a synthetic JMdict")
+    parser.add_argument("-o", help="Output JSON report (default: print to stdout)")
+    parser.add_argument("--entries", type=int, default=200000, help="Number of synthetic JMdict entries")
+    parser.add_argument("--queries", type=int, default=20000, help="Number of query words")
+    parser.add_argument("--formats", nargs="+", default=["binary", "json"], choices=["binary", "json"], help="Dictionary formats to measure")
+    parser.add_argument("--runs", type=int, default=3, help="Number of fresh processes per format")
+    parser.add_argument("--min-time", type=float, default=1.0, help="Minimum seconds per throughput measurement")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="Processes for generate_jdict.py")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--work-dir", help="Directory for the generated files (default: temporary)")
+    parser.add_argument("--worker", nargs=2, metavar=("DICT", "QUERIES"), help=argparse.SUPPRESS)
+    parser.add_argument("--generate", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(*args.worker, args.min_time)
+        return
+    if args.generate:
+        run_generate(args.generate)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+        jmdict_path = os.path.join(work_dir, "JMdict_synthetic.gz")
+        print(f"Generating {args.entries} synthetic JMdict entries at {jmdict_path}", file=sys.stderr, flush=True)
+        entries = generate_jmdict(jmdict_path, args.entries, args.seed)
+
+        queries_path = os.path.join(work_dir, "queries.json")
+        queries = generate_queries(entries, args.queries, args.seed)
+        with open(queries_path, "wt", encoding="utf-8") as f:
+            json.dump(queries, f, ensure_ascii=False)
+
+        report = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "entries": args.entries,
+            "query_words": len(queries["words"]),
+            "query_sentences": len(queries["sentences"]),
+            "seed": args.seed,
+            "formats": { },
+        }
+
+        for fmt in args.formats:
+            dict_path = os.path.join(work_dir, "jdict_binary.bin" if fmt == "binary" else "jdict_json.json")
+            print(f"Compiling the {fmt} dictionary", file=sys.stderr, flush=True)
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--generate",
+                "--jmdict-path", jmdict_path, "--conj-table-path", os.path.join(gen_dir, "tables"),
+                "-o", dict_path, "--format", fmt, "--threads", str(args.threads)],
+                check=True, stdout=subprocess.PIPE).stdout
+            generate = json.loads(output)
+
+            runs = []
+            for n in range(args.runs):
+                print(f"Measuring the {fmt} dictionary, run {n+1}/{args.runs}", file=sys.stderr, flush=True)
+                output = subprocess.run([sys.executable, os.path.abspath(__file__),
+                    "--worker", dict_path, queries_path, "--min-time", str(args.min_time)],
+                    check=True, stdout=subprocess.PIPE).stdout
+                runs.append(json.loads(output))
+
+            report["formats"][fmt] = {
+                "generate": generate,
+                "files": file_sizes(dict_path),
+                "median": summarize(runs),
+                "runs": runs,
+            }
+
+    text = json.dumps(report, indent=1)
+    if args.o:
+        with open(args.o, "wt", encoding="utf-8") as f:
+            f.write(text)
+        print(f"Wrote the report to {args.o}", file=sys.stderr, flush=True)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -2,29 +2,24 @@
 
 import xml.etree.ElementTree as ET
 import conj
-from collections import namedtuple
+from collections import namedtuple, deque
+from contextlib import contextmanager
 import json
 import time
 import argparse
+import functools
 import gzip
-
-parser = argparse.ArgumentParser(description="Generate jdict.json")
-parser.add_argument("--jmdict-path", help="Path to the JMDict to use")
-parser.add_argument("--conj-table-path", help="Path for directory containing conjugation csv files")
-parser.add_argument("-o", help="Output filename")
-args = parser.parse_args()
-
-start = time.time()
-
-print(f"Parsing JMDict {args.jmdict_path}...", flush=True)
-if args.jmdict_path.endswith(".gz"):
-    with gzip.open(args.jmdict_path, "rb") as f:
-        root = ET.parse(f)
-else:
-    root = ET.parse(args.jmdict_path)
-
-print(f"Loading conjugation tables from {args.conj_table_path}...", flush=True)
-ct = conj.read_conj_tables(args.conj_table_path)
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 def encode_base(id, kanji, index):
     assert 0 <= id < (1 << 18)
@@ -32,145 +27,588 @@ def encode_base(id, kanji, index):
     assert 0 <= index < (1 << 5)
     return id | kanji << 18 | index << 19
 
-def encode_conjugation(id, kanji, index, neg, fml, cj):
+def encode_hidden(id, kanji, index, pos_class):
     assert 0 <= id < (1 << 18)
     assert 0 <= kanji <= 1
     assert 0 <= index < (1 << 5)
-    assert 1 <= cj < (1 << 4)
-    assert 0 <= fml <= 1
-    assert 0 <= neg <= 1
-    return id | kanji << 18 | index << 19 | cj << 24 | fml << 28 | neg << 29
+    assert 0 <= pos_class < (1 << 6)
+    return id | kanji << 18 | index << 19 | pos_class << 24 | 1 << 30
 
-def conjugate(txt, position, id, kanji, index):
-    try: pos = ct['kwpos'][position][0]
-    except KeyError:
-        raise ValueError("unknown part-of-speech: %s\n'conj.py --list' will "
-            "print a list of conjugatable parts-of-speech" % position)
-    if pos not in [x[0] for x in ct['conjo']]:
-        return
+def encode_conjugated(id, kanji, index, cj, neg, fml):
+    assert 0 <= cj < (1 << 4)
+    return encode_base(id, kanji, index) | cj << 24 | fml << 28 | neg << 29
+
+ct = None
+conj_rows = None
+conj_pos_classes = None
+conj_max_stems = None
+
+def load_conj_tables(path):
+    """Read the conjugation tables and index the rows by part-of-speech"""
+    global ct, conj_rows, conj_pos_classes, conj_max_stems
 
-    # Get pos number from kw:
+    ct = conj.read_conj_tables(path)
+
+    # Conjugation rows of each conjugatable part-of-speech in (conj, neg, fml, onum) order
+    conj_rows = { }
     for conj2,conjnm in sorted (ct['conj'].values(), key=lambda x:x[0]):
         for neg, fml in (0,0),(0,1),(1,0),(1,1):
             neg, fml = bool (neg), bool (fml)
-            for onum in range(1,10):  # onum values start at 1, not 0.
-                try: _,_,_,_,_, stem, okuri, euphr, euphk, _ \
-                    = ct['conjo'][pos,conj2,neg,fml,onum]
-                except KeyError: break
-
-                kt = conj.construct (txt, stem, okuri, euphr, euphk) \
-                        if len(txt) >= 2 else ''
-
-                if kt:
-                    yield kt, encode_conjugation(id, kanji, index, neg, fml, conj2)
-
-words = [ ]
-infos = { }
-
-word_to_cdata = { }
-def add_word_to_cdata(word, cdata):
-    global word_to_cdata
-
-    prev = word_to_cdata.get(word)
-    if not prev:
-        word_to_cdata[word] = cdata
-    elif isinstance(prev, list):
-        if cdata not in prev:
-            prev.append(cdata)
-    elif prev != cdata:
-        word_to_cdata[word] = [prev, cdata]
-
-pos_descs = { c[0]: c[2] for c in ct['kwpos'].values() }
-inv_pos_descs = { v: k for k,v in pos_descs.items() }
-
-counter = 0
-
-max_kr = 0
-
-print("Processing words, this will take a while (printing one '.' per 10k words)", flush=True)
-
-for id, entry in enumerate(root.iter("entry")):
-    pos = entry.findtext("sense/pos") or "unclassified"
-    gloss = entry.findall("sense/gloss")
-
-    counter += 1
-    if counter % 10000 == 0:
-        print(".", end="", flush=True)
-
-    if pos not in inv_pos_descs:
-        pos_id = max(pos_descs.keys()) + 1
-        pos_descs[pos_id] = pos
-        inv_pos_descs[pos] = pos_id
-
-    eles = [[], []]
-
-    for kanji, ele_name in enumerate(("r_ele", "k_ele")):
-        for index, ele in enumerate(entry.findall(ele_name)):
-            conjugated = False
-            eb = ele.findtext("keb" if kanji else "reb")
-
-            pris = frozenset(e.text for e in ele.findall("ke_pri" if kanji else "re_pri"))
-            inf = frozenset(e.text for e in ele.findall("ke_inf" if kanji else "re_inf"))
-            info = (pris, inf)
-
-            info_id = infos.get(info, 0)
-            if info_id == 0:
-                info_id = len(infos)
-                infos[info] = info_id
-
-            eles[kanji].append((eb, info_id))
-            if eb:
-                for word, cdata in conjugate(eb, pos, id, kanji, index):
-                    if len(word) > 1:
-                        add_word_to_cdata(word, cdata)
-                        conjugated = True
-            if not conjugated:
-                cdata = encode_base(id, kanji, index)
-                add_word_to_cdata(eb, cdata)
-
-        max_kr = max(max_kr, len(eles[kanji]))
-
-    word = {
-        "kanji": eles[1],
-        "kana": eles[0],
-        "pos": inv_pos_descs[pos],
-        "gloss": [g.text for g in gloss],
-    }
-    words.append(word)
+            for pos in sorted(set(x[0] for x in ct['conjo'])):
+                for onum in range(1,10):  # onum values start at 1, not 0.
+                    try: _,_,_,_,_, stem, okuri, euphr, euphk, _ \
+                        = ct['conjo'][pos,conj2,neg,fml,onum]
+                    except KeyError: break
+                    conj_rows.setdefault(pos, []).append((conj2, neg, fml, stem, okuri, euphr, euphk))
 
-conj_descs = { str(c[0]): c[1] for c in ct['conj'].values() }
-info_list = [{
-    "priority": sorted(list(pri)),
-    "info": list(inf)
-} for pri, inf in infos]
+    # Hidden base entries and rules refer to parts-of-speech by their index here
+    conj_pos_classes = { pos: ix for ix, pos in enumerate(sorted(conj_rows)) }
 
-conj_list = ["Unconjugated"] * (len(ct["conj"]) + 1)
-pos_list = [""] * (max(pos_descs.keys()) + 1)
+    # Number of trailing characters conjugation can replace, including euphonic changes
+    conj_max_stems = { pos: max(r[3] + bool(r[5] or r[6]) for r in rows) for pos, rows in conj_rows.items() }
 
-for c in ct["conj"].values():
-    conj_list[c[0]] = c[1]
+    ending_rules.cache_clear()
 
-for ix, pos in pos_descs.items():
-    pos_list[ix] = pos
+def rule_key(txt, position):
+    """Return the `ending_rules()` arguments for `txt` or None if it doesn't conjugate
 
-result = {
-    "conj": conj_list,
-    "pos": pos_list,
-    "infos": info_list,
-    "words": words,
-    "str_to_word": word_to_cdata,
-}
+    Conjugation only looks at the end of the word, so all words sharing the
+    key have the same rules."""
 
-print(" Done!", flush=True)
+    try: pos = ct['kwpos'][position][0]
+    except KeyError:
+        raise ValueError("unknown part-of-speech: %s\n'conj.py --list' will "
+            "print a list of conjugatable parts-of-speech" % position)
+    if pos not in conj_rows or len(txt) < 2:
+        return None
+
+    iskana = txt[-2] > 'あ' and txt[-2] <= 'ん'
+    max_stem = conj_max_stems[pos]
+    return pos, txt[-max_stem:] if max_stem else "", iskana
+
+@functools.lru_cache(maxsize=None)
+def ending_rules(pos, ending, iskana):
+    """Return the deinflection rules of words of `pos` ending in `ending`
+
+    Rules are `(suffix, base, kana, pos_class, conj, neg, fml)` tuples: a
+    conjugated word ending in `suffix` is deinflected by replacing it with
+    `base`. `kana` must match the kana test of `conj.construct()` for the base.
+
+    Also returns the distinct `(stem, suffix length)` pairs of the rules which
+    determine the lengths of the conjugated forms, and `(suffix, conj, neg, fml)`
+    of the rows with a zero stem. `conj.construct()` replaces the whole word
+    with the suffix for those so they don't depend on the word and are stored
+    as plain entries instead of rules."""
+
+    rules = []
+    lengths = set()
+    fixed = []
+    for conj2, neg, fml, stem, okuri, euphr, euphk in conj_rows[pos]:
+        euph = euphr if iskana else euphk
+        if euph: stem += 1
+        suffix = (euph or '') + okuri
+        if stem == 0:
+            fixed.append((suffix, conj2, neg, fml))
+            continue
+        rules.append((suffix, ending[-stem:], iskana, conj_pos_classes[pos], conj2, neg, fml))
+        lengths.add((stem, len(suffix)))
+    return rules, lengths, fixed
+
+# The folded index maps keys with katakana folded to hiragana and long vowel
+# marks and whitespace removed, so that words match regardless of the script
+# they are written in. The table is stored in the dictionary for `JDict`.
+FOLD_KATAKANA = "".join(chr(c) for c in range(0x30a1, 0x30f7)) + "ヽヾ"
+FOLD_HIRAGANA = "".join(chr(c) for c in range(0x3041, 0x3097)) + "ゝゞ"
+FOLD_STRIP = "ー"
+fold_table = str.maketrans(FOLD_KATAKANA, FOLD_HIRAGANA, FOLD_STRIP)
+
+def fold_key(text):
+    return "".join(ch for ch in text.translate(fold_table) if not ch.isspace())
+
+def fold_index(str_to_word):
+    """Merge the entries of `str_to_word` by folded key"""
+    folded = { }
+    for key, value in str_to_word.items():
+        folded_key = fold_key(key)
+        if not folded_key: continue
+        entries = folded.setdefault(folded_key, [])
+        for cdata in value if isinstance(value, list) else [value]:
+            if cdata not in entries:
+                entries.append(cdata)
+    return { k: v if len(v) > 1 else v[0] for k, v in folded.items() }
+
+# Keep in sync with `prio_score` in mangofy.py
+PRIORITY_SCORES = {
+    "news1": 3,
+    "ichi1": 3,
+    "spec1": 2,
+    "gai1": 2,
+    "nf01": 4,
+    "nf02": 3,
+    "nf03": 2,
+}
 
-print(f"Writing the output JSON file at {args.o}...", flush=True)
-if args.o.endswith(".gz"):
-    with gzip.open(args.o, "wt", encoding="utf-8", compresslevel=9) as f:
-        json.dump(result, f, ensure_ascii=False, indent=1)
-else:
-    with open(args.o, "w", encoding="utf-8") as f:
-        json.dump(result, f, ensure_ascii=False, indent=1)
+def priority_score(priority):
+    return max((PRIORITY_SCORES.get(p, 1) for p in priority), default=0)
+
+def entry_order(cdata):
+    """Same as `entry_order()` in jdict.py"""
+    return (cdata & ((1 << 18) - 1), (cdata >> 18) & 1, (cdata >> 19) & 31,
+        (cdata >> 24) & 15, (cdata >> 29) & 1, (cdata >> 28) & 1)
+
+def entry_scorer(words, info_scores):
+    """Return a function giving the priority score of the result a cdata entry maps to"""
+    def score(cdata):
+        word = words[cdata & ((1 << 18) - 1)]
+        kind = "kanji" if (cdata >> 18) & 1 else "kana"
+        # `JDict._results()` reports the info of the element at `bool(index)`
+        index = bool((cdata >> 19) & 31)
+        return info_scores[word[kind][index][1]]
+    return score
+
+def sort_entries(table, score):
+    """Order the entries of every key best first so `JDict.lookup_top()` can stop early"""
+    for key, value in table.items():
+        if isinstance(value, list):
+            value.sort(key=lambda c: (-score(c), entry_order(c)))
+
+def fuzzy_index(keys):
+    """Map every single character deletion of `keys` to the keys it came from
+
+    Two strings are within edit distance one if one is a deletion of the other
+    or they share a deletion at the same position (symmetric delete), so the
+    lookup only needs the deletions of the query. Single character keys are
+    left out as everything is one edit away from them."""
+
+    deletions = { }
+    for key in keys:
+        if len(key) < 2: continue
+        for variant in sorted(set(key[:i] + key[i+1:] for i in range(len(key)))):
+            deletions.setdefault(variant, []).append(key)
+    return deletions
+
+# Auxiliaries following the te-form are stripped at lookup time and relabel the
+# te-form result. Every conjugation of the auxiliary is included so chained forms
+# such as 食べていなかった resolve. Contracted auxiliaries drop the first kana
+# (食べている -> 食べてる).
+auxiliaries = [
+    # (auxiliary, part-of-speech, conjugation name, contracted)
+    ("いる", "v1", "Progressive", False),
+    ("いる", "v1", "Progressive", True),
+    ("おく", "v5k", "Future", False),
+    ("ある", "v5r-i", "Finished", False),
+]
+
+def auxiliary_rules():
+    """Return `(suffix, strip, base_conj, conjugation, neg, fml)` tuples
+
+    A word ending in `suffix` is looked up with `strip` characters removed and
+    te-form (`base_conj`) results are relabeled with `conjugation`."""
+
+    conj_ids = { c[1].split(" ")[0]: c[0] for c in ct['conj'].values() }
+    te_conj = conj_ids["Conjunctive"]
+    rules = []
+    for aux, position, name, contracted in auxiliaries:
+        pos = ct['kwpos'][position][0]
+        for conj2, neg, fml, stem, okuri, euphr, euphk in conj_rows[pos]:
+            # The bare stem (見てい) is always followed by another inflection
+            if conj2 == conj_ids["Continuative"]: continue
+            form = conj.construct(aux, stem, okuri, euphr, euphk)
+            if contracted:
+                form = form[1:]
+                if not form: continue
+            label = name if conj2 == conj_ids["Non-past"] else f"{name} {ct['conj'][conj2][1]}"
+            for te in ("て", "で"):
+                rule = (te + form, len(form), te_conj, label, neg, fml)
+                if rule not in rules:
+                    rules.append(rule)
+    return rules
+
+@contextmanager
+def phase(name):
+    """Report the wall time and peak memory of a phase of the generation"""
+    begin = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - begin
+    if resource:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+        memory = f", peak RSS {peak_self / 1e6:.0f}MB (workers {peak_children / 1e6:.0f}MB)"
+    else:
+        memory = ""
+    print(f"{name} took {elapsed:.1f}s{memory}", flush=True)
+
+def read_entries(path):
+    """Stream JMDict entries as `(pos, elements, gloss)` tuples
+
+    `elements` is a pair of kana and kanji element lists containing
+    `(text, priorities, infos)` tuples. Entries are cleared after being read
+    so the whole tree is never resident."""
+
+    f = gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+    with f:
+        root = None
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end" or elem.tag != "entry":
+                continue
+
+            pos = elem.findtext("sense/pos") or "unclassified"
+            eles = ([], [])
+            for kanji, ele_name in enumerate(("r_ele", "k_ele")):
+                for ele in elem.findall(ele_name):
+                    eles[kanji].append((
+                        ele.findtext("keb" if kanji else "reb"),
+                        frozenset(e.text for e in ele.findall("ke_pri" if kanji else "re_pri")),
+                        frozenset(e.text for e in ele.findall("ke_inf" if kanji else "re_inf")),
+                    ))
+            gloss = [g.text for g in elem.findall("sense/gloss")]
+            yield pos, eles, gloss
+
+            elem.clear()
+            root.clear()
+
+def batch_entries(entries, size):
+    """Group entries into `(first_id, entries)` batches"""
+    batch = []
+    first_id = 0
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield first_id, batch
+            first_id += len(batch)
+            batch = []
+    if batch:
+        yield first_id, batch
+
+def process_batch(batch):
+    """Resolve the index entries of a batch of words, runs in a worker process
+
+    Returns the `(text, cdata)` pairs of each entry and the set of
+    `ending_rules()` keys used by the batch."""
+
+    first_id, entries = batch
+    rule_keys = set()
+    entry_cdata = []
+    for id, (pos, eles, gloss) in enumerate(entries, first_id):
+        cdatas = []
+        for kanji in (0, 1):
+            for index, (eb, pris, inf) in enumerate(eles[kanji]):
+                key = rule_key(eb, pos) if eb else None
+                conjugated = False
+                fixed = []
+                if key:
+                    rules, lengths, fixed = ending_rules(*key)
+                    if rules:
+                        rule_keys.add(key)
+                    # Only conjugated forms longer than one character are looked up
+                    fixed = [f for f in fixed if len(f[0]) > 1]
+                    conjugated = bool(fixed) or any(max(len(eb) - stem, 0) + num > 1 for stem, num in lengths)
+                if conjugated:
+                    cdata = encode_hidden(id, kanji, index, conj_pos_classes[key[0]])
+                else:
+                    cdata = encode_base(id, kanji, index)
+                cdatas.append((eb, cdata))
+                for suffix, conj2, neg, fml in fixed:
+                    cdatas.append((suffix, encode_conjugated(id, kanji, index, conj2, neg, fml)))
+        entry_cdata.append(cdatas)
+    return entry_cdata, rule_keys
+
+def generate(jmdict_path, conj_table_path, threads):
+    """Build the dictionary tables from a JMDict file"""
+
+    words = [ ]
+    infos = { }
+    rule_keys = set()
+
+    word_to_cdata = { }
+    def add_word_to_cdata(word, cdata):
+        prev = word_to_cdata.get(word)
+        if not prev:
+            word_to_cdata[word] = cdata
+        elif isinstance(prev, list):
+            if cdata not in prev:
+                prev.append(cdata)
+        elif prev != cdata:
+            word_to_cdata[word] = [prev, cdata]
+
+    pos_descs = { c[0]: c[2] for c in ct['kwpos'].values() }
+    inv_pos_descs = { v: k for k,v in pos_descs.items() }
+
+    counter = 0
+
+    # Batches are processed in parallel but `imap()` returns them in order so the
+    # word ids and info ids are deterministic. `pending` keeps the batches for
+    # merging, `imap()` consumes `feed()` before the results come back.
+    pending = deque()
+    def feed():
+        for batch in batch_entries(read_entries(jmdict_path), 2000):
+            pending.append(batch)
+            yield batch
+
+    pool = multiprocessing.Pool(threads, load_conj_tables, (conj_table_path,)) if threads > 1 else None
+    try:
+        if pool:
+            processed = ((pending.popleft(), r) for r in pool.imap(process_batch, feed()))
+        else:
+            processed = ((batch, process_batch(batch)) for batch in feed())
+
+        for (first_id, entries), (entry_cdata, batch_rule_keys) in processed:
+            rule_keys |= batch_rule_keys
+            for (pos, eles, gloss), cdatas in zip(entries, entry_cdata):
+                counter += 1
+                if counter % 10000 == 0:
+                    print(".", end="", flush=True)
+
+                if pos not in inv_pos_descs:
+                    pos_id = max(pos_descs.keys()) + 1
+                    pos_descs[pos_id] = pos
+                    inv_pos_descs[pos] = pos_id
+
+                word_eles = [[], []]
+                for kanji in (0, 1):
+                    for eb, pris, inf in eles[kanji]:
+                        info = (pris, inf)
+                        info_id = infos.get(info)
+                        if info_id is None:
+                            info_id = len(infos)
+                            infos[info] = info_id
+                        word_eles[kanji].append((eb, info_id))
+
+                for eb, cdata in cdatas:
+                    add_word_to_cdata(eb, cdata)
+
+                words.append({
+                    "kanji": word_eles[1],
+                    "kana": word_eles[0],
+                    "pos": inv_pos_descs[pos],
+                    "gloss": gloss,
+                })
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    print(" Done!", flush=True)
+
+    info_list = [{
+        "priority": sorted(list(pri)),
+        "info": list(inf)
+    } for pri, inf in infos]
+    info_scores = [priority_score(info["priority"]) for info in info_list]
+
+    folded = fold_index(word_to_cdata)
+    score = entry_scorer(words, info_scores)
+    sort_entries(word_to_cdata, score)
+    sort_entries(folded, score)
+
+    rules = set()
+    for key in rule_keys:
+        rules.update(ending_rules(*key)[0])
+
+    conj_list = ["Unconjugated"] * (len(ct["conj"]) + 1)
+    pos_list = [""] * (max(pos_descs.keys()) + 1)
+
+    for c in ct["conj"].values():
+        conj_list[c[0]] = c[1]
+
+    for ix, pos in pos_descs.items():
+        pos_list[ix] = pos
+
+    return {
+        "version": BINARY_VERSION,
+        "conj": conj_list,
+        "pos": pos_list,
+        "infos": info_list,
+        "info_scores": info_scores,
+        "rules": sorted(rules),
+        "aux_rules": auxiliary_rules(),
+        "fold": { "katakana": FOLD_KATAKANA, "hiragana": FOLD_HIRAGANA, "strip": FOLD_STRIP },
+        "words": words,
+        "str_to_word": word_to_cdata,
+        "folded": folded,
+        "fuzzy": fuzzy_index(sorted(folded)),
+    }
 
-end = time.time()
+BINARY_MAGIC = b"JDCT"
+# Also the `version` of the JSON format
+BINARY_VERSION = 7
+RECORDS_MAGIC = b"JREC"
+RECORDS_HEADER = struct.Struct("<4sI")
+
+def u32_bytes(values):
+    arr = array("I", values)
+    assert arr.itemsize == 4
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+def build_trie(keys):
+    """Serialize sorted `keys` into a u32 trie, see jdict.py for the layout"""
+
+    if not keys: return [1, 0, 0]
+    nodes = [0]
+
+    # Post-order so that parents know the offsets of their children
+    def build(lo, hi, depth):
+        value = 0
+        if len(keys[lo]) == depth:
+            value = lo + 1
+            lo += 1
+        chars = []
+        children = []
+        while lo < hi:
+            ch = keys[lo][depth]
+            end = lo + 1
+            while end < hi and keys[end][depth] == ch:
+                end += 1
+            chars.append(ord(ch))
+            children.append(build(lo, end, depth + 1))
+            lo = end
+        offset = len(nodes)
+        nodes.extend((value, len(chars)))
+        nodes.extend(chars)
+        nodes.extend(children)
+        return offset
+
+    nodes[0] = build(0, len(keys), 0)
+    return nodes
+
+def table_sections(name, table, score):
+    """Sections of a str -> cdata table: trie, offsets, values and their scores"""
+
+    # Keys are sorted by UTF-8 bytes which matches code point order in `str`
+    keys = sorted(table.keys())
+    value_data = []
+    value_offsets = [0]
+    for key in keys:
+        value = table[key]
+        value_data += value if isinstance(value, list) else [value]
+        value_offsets.append(len(value_data))
+
+    return [
+        (name + ".trie", u32_bytes(build_trie(keys))),
+        (name + ".offsets", u32_bytes(value_offsets)),
+        (name + ".values", u32_bytes(value_data)),
+        (name + ".scores", bytes(score(c) for c in value_data)),
+    ]
+
+def fuzzy_sections(name, fuzzy, keys):
+    """Sections of the deletion index, see jdict.py for the layout
+
+    `keys` are the keys of the folded table the deletions refer to."""
+
+    key_data = bytearray()
+    key_offsets = [0]
+    for key in keys:
+        key_data += key.encode("utf-8")
+        key_offsets.append(len(key_data))
+
+    key_index = { key: ix for ix, key in enumerate(keys) }
+    pairs = sorted((zlib.crc32(variant.encode("utf-8")), key_index[key])
+        for variant, variant_keys in fuzzy.items() for key in variant_keys)
+
+    return [
+        (name + ".keys", bytes(key_data)),
+        (name + ".key_offsets", u32_bytes(key_offsets)),
+        (name + ".hashes", u32_bytes(h for h, _ in pairs)),
+        (name + ".targets", u32_bytes(k for _, k in pairs)),
+    ]
+
+def records_path(path):
+    """Path of the record file that goes with the binary dictionary `path`"""
+    return os.path.splitext(path)[0] + ".records"
+
+def write_binary(path, result):
+    """Write `result` as a memory-mappable index and a record file, see jdict.py for the layout"""
+
+    # Records are read on demand so they are kept out of the index file
+    record_offsets = [RECORDS_HEADER.size]
+    with open(records_path(path), "wb") as f:
+        f.write(RECORDS_HEADER.pack(RECORDS_MAGIC, BINARY_VERSION))
+        for word in result["words"]:
+            f.write(json.dumps(word, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+            record_offsets.append(f.tell())
+
+    meta = {
+        "conj": result["conj"],
+        "pos": result["pos"],
+        "infos": result["infos"],
+        "info_scores": result["info_scores"],
+        "rules": result["rules"],
+        "aux_rules": result["aux_rules"],
+        "fold": result["fold"],
+        "records": os.path.basename(records_path(path)),
+        "records_size": record_offsets[-1],
+    }
 
-print(f"Finished in {end - start:.1f} seconds!", flush=True)
+    sections = [
+        ("meta", json.dumps(meta, ensure_ascii=False).encode("utf-8")),
+        ("record_offsets", u32_bytes(record_offsets)),
+    ]
+    score = entry_scorer(result["words"], result["info_scores"])
+    sections += table_sections("str_to_word", result["str_to_word"], score)
+    sections += table_sections("folded", result["folded"], score)
+    sections += fuzzy_sections("fuzzy", result["fuzzy"], sorted(result["folded"]))
+
+    header = struct.Struct("<4sII")
+    entry = struct.Struct("<32sII")
+
+    offset = header.size + entry.size * len(sections)
+    directory = []
+    for name, data in sections:
+        offset = (offset + 7) & ~7
+        directory.append((name, offset, len(data)))
+        offset += len(data)
+
+    with open(path, "wb") as f:
+        f.write(header.pack(BINARY_MAGIC, BINARY_VERSION, len(sections)))
+        for name, offset, size in directory:
+            assert len(name) <= 32
+            f.write(entry.pack(name.encode("ascii"), offset, size))
+        for (name, offset, size), (_, data) in zip(directory, sections):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate jdict.json")
+    parser.add_argument("--jmdict-path", help="Path to the JMDict to use")
+    parser.add_argument("--conj-table-path", help="Path for directory containing conjugation csv files")
+    parser.add_argument("-o", help="Output filename")
+    parser.add_argument("--format", choices=["json", "binary"], help="Output format (default: binary for .bin, otherwise json)")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="Number of processes to use")
+    args = parser.parse_args()
+
+    if not args.format:
+        args.format = "binary" if args.o.endswith(".bin") else "json"
+
+    start = time.time()
+
+    print(f"Loading conjugation tables from {args.conj_table_path}", flush=True)
+    with phase("Loading conjugation tables"):
+        load_conj_tables(args.conj_table_path)
+
+    print(f"Processing JMDict {args.jmdict_path} with {args.threads} processes (printing one '.' per 10k words)", flush=True)
+    with phase("Processing words"):
+        result = generate(args.jmdict_path, args.conj_table_path, args.threads)
+
+    print(f"Writing the output {args.format} file at {args.o}", flush=True)
+    with phase("Writing output"):
+        if args.format == "binary":
+            write_binary(args.o, result)
+        elif args.o.endswith(".gz"):
+            with gzip.open(args.o, "wt", encoding="utf-8", compresslevel=9) as f:
+                json.dump(result, f, ensure_ascii=False, indent=1)
+        else:
+            with open(args.o, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=1)
+
+    end = time.time()
+
+    print(f"Finished in {end - start:.1f} seconds!", flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,117 @@
 #!/usr/bin/env python3
-from http.server import HTTPServer, SimpleHTTPRequestHandler, test
-import sys
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import argparse
+import functools
+import json
+import os
+
+# Set with `--jdict`, serves alt hints to pages built with `mangofy.py --no-alt-hints`
+hint_service = None
+
+class HintService:
+    """Computes the alt hint of a symbol range of a page on demand
+
+    The dictionary stays loaded in-process, the paragraphs of recently used
+    pages and the encoded responses are kept in LRU caches keyed by the page
+    modification time so rebuilt pages are picked up."""
+
+    def __init__(self, args):
+        import mangofy
+        self.mangofy = mangofy
+        mangofy.load_jdict(args.jdict, args.lookup_cache_size, args.max_results)
+        if args.wanikani:
+            mangofy.load_wanikani(args.wanikani)
+        self.paragraphs = functools.lru_cache(maxsize=args.page_cache_size)(self.paragraphs)
+        self.response = functools.lru_cache(maxsize=args.hint_cache_size)(self.response)
+
+    def paragraphs(self, path, mtime):
+        return self.mangofy.load_page_paragraphs(path)
+
+    def response(self, path, mtime, para_ix, sym_begin, sym_end):
+        paragraphs = self.paragraphs(path, mtime)
+        if not 0 <= para_ix < len(paragraphs):
+            raise ValueError("paragraph out of bounds")
+        paragraph = paragraphs[para_ix]
+        if not 0 <= sym_begin < sym_end <= len(paragraph["symbols"]):
+            raise ValueError("symbol range out of bounds")
+        hint = self.mangofy.get_alt_hint(paragraph, sym_begin, sym_end)
+        if hint:
+            hint = dict(hint, results=[self.inline_radicals(r) for r in hint["results"]])
+        return json.dumps(hint, ensure_ascii=False).encode("utf-8")
+
+    def inline_radicals(self, result):
+        # The radicals file of the volume may not have the radicals used only
+        # by on-demand hints so they are sent inline
+        if "radicals" not in result: return result
+        return dict(result, radicals=[self.mangofy.wk_radicals[id] for id in result["radicals"]])
 
 class CORSRequestHandler (SimpleHTTPRequestHandler):
     def end_headers (self):
         self.send_header('Access-Control-Allow-Origin', '*')
         SimpleHTTPRequestHandler.end_headers(self)
 
+    def do_GET (self):
+        url = urlsplit(self.path)
+        if url.path == '/api/hints':
+            self.send_hint(parse_qs(url.query))
+        else:
+            SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_hint (self, query):
+        if not hint_service:
+            self.send_error(404, "Hints are served only with --jdict")
+            return
+
+        try:
+            page = query['page'][0]
+            para_ix, sym_begin, sym_end = (int(query[k][0]) for k in ('paragraph', 'begin', 'end'))
+        except (KeyError, ValueError):
+            self.send_error(400, "Expected page, paragraph, begin and end")
+            return
+
+        path = self.translate_path(page)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self.send_error(404, "Page not found")
+            return
+
+        try:
+            body = hint_service.response(path, mtime, para_ix, sym_begin, sym_end)
+        except OSError:
+            self.send_error(404, "Page not found")
+            return
+        except KeyError as e:
+            self.send_error(400, f"Not a page, missing {e}")
+            return
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
 def run(port):
     server_address = ('0.0.0.0', port)
     httpd = HTTPServer(server_address, CORSRequestHandler)
     httpd.serve_forever()
 
 if __name__ == '__main__':
-    run(int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    parser = argparse.ArgumentParser(description="Serve the web viewer and built volumes")
+    parser.add_argument("port", type=int, nargs="?", default=8000, help="Port to listen on")
+    parser.add_argument("--jdict", help="Japanese dictionary .json or .bin file, enables the /api/hints endpoint")
+    parser.add_argument("--wanikani", help="WaniKani subject .json file for hints")
+    parser.add_argument("--lookup-cache-size", type=int, default=16384, help="Number of dictionary lookups to cache")
+    parser.add_argument("--max-results", type=int, default=0, help="Keep only the best N dictionary results per hint (default: all)")
+    parser.add_argument("--page-cache-size", type=int, default=64, help="Number of pages to keep parsed")
+    parser.add_argument("--hint-cache-size", type=int, default=4096, help="Number of hint responses to cache")
+    args = parser.parse_args()
+
+    if args.jdict:
+        hint_service = HintService(args)
+
+    run(args.port)
@@ -16,14 +16,37 @@ import glob
 import requests
 import base64
 import multiprocessing
-import hashlib
-from collections import namedtuple
+import asyncio
+import time
+import gc
+from array import array
+import numpy as np
+from collections import namedtuple, OrderedDict
 from open_ex import open_ex
+from ocr_cache import OcrCache
+from ocr_backends import GoogleVisionBackend, OfflineBackend
 
 DescTask = namedtuple("DescTask", "path num_pages")
 PageTask = namedtuple("PageTask", "path page index desc")
+Segment = namedtuple("Segment", "begin end text results fuzzy")
 
 g_unsafe_write = False
+g_fuzzy = True
+g_max_results = 0
+g_segmentation = "greedy"
+g_page_format = "json"
+g_split_hints = False
+g_alt_hints = True
+g_volume_dict = False
+g_ocr_backend = "google"
+g_ocr_max_height = 0
+g_ocr_jpeg_quality = 90
+g_initialized = False
+
+# Written next to the pages with `--volume-dict`
+VOLUME_DICT_NAME = "dictionary.json"
+# Written next to the pages with `--wanikani`
+RADICALS_NAME = "radicals.json"
 
 log_name = None
 def log(*values, **kwargs):
@@ -51,17 +74,22 @@ HIRAGANA = (
     "せぜそぞただちぢっつづてでとどなにぬねのはばぱひびぴ"
     "ふぶぷへべぺほぼぽまみむめもゃやゅゆょよらりるれろわ"
     "をんーゎゐゑゕゖゔゝゞ・「」。、")
-KATAKANA = (
-    "ァアィイゥウェエォオカガキギクグケゲコゴサザシジスズセゼソ"
-    "ゾタダチヂッツヅテデトドナニヌネノハバパヒビピフブプヘベペ"
-    "ホボポマミムメモャヤュユョヨラリルレロワヲンーヮヰヱヵヶヴ"
-    "ヽヾ・「」。、")
 
-KATAKANA_TO_HIRAGANA = { ord(k): ord(h) for k,h in zip(KATAKANA, HIRAGANA) }
+def is_kanji(ch):
+    return "\u4e00" <= ch <= "\u9fff"
+
+def is_japanese(ch):
+    return "ぁ" <= ch <= "ゖ" or "ァ" <= ch <= "ヺ" or is_kanji(ch)
 
 wk_subjects = { }
+# Subject ids by characters
 wk_kanjis = { }
 wk_vocabs = { }
+# Images of the radicals referenced by hints so far, written once per volume
+# to `RADICALS_NAME` and resolved by the viewer
+wk_radicals = { }
+# Every prefix of the `wk_kanjis` and `wk_vocabs` keys
+wk_prefixes = set()
 
 en_words = set()
 
@@ -71,11 +99,6 @@ def bounds_to_aabb(box):
         "max": (max(v.x for v in box.vertices), max(v.y for v in box.vertices)),
     }
 
-lang_hint = {
-    "jp": "ja-Jpan",
-    "en": "en-t-i0-handwrit",
-}
-
 def format_break(line_break, BreakType):
     if not line_break: return None
     btype = line_break.type_
@@ -88,42 +111,30 @@ def format_break(line_break, BreakType):
         "prefix": prefix,
     }
 
-def detect_page_ocr(path, language):
-    """Detects document features in an image."""
+# Results of the older per-image cache files are moved to `--ocr-cache`
+OCR_LEGACY_DIR = os.path.join("temp", "ocr03")
 
-    with io.open(path, 'rb') as image_file:
-        content = image_file.read()
-    
-    content_hash = hashlib.sha256(content).hexdigest()
+# Set in `initialize()` or before forking the workers so that they share
+# the prefetched results
+ocr_cache = None
 
-    tmp_name = f"{content_hash}.json.gz"
-    tmp_path = os.path.join("temp", "ocr03", tmp_name)
-    try:
-        with open_ex(tmp_path, "rb") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        pass
+# Set in `initialize()` from `--ocr-backend`
+ocr_backend = None
 
-    log(f".. Processing OCR: {path} ({language})")
-
-    from google.cloud import vision
-    client = vision.ImageAnnotatorClient()
-
-    image = vision.Image(content=content)
-
-    with Image.open(BytesIO(content)) as img:
-        resolution = img.size
-
-    response = client.document_text_detection(
-        image=image,
-        image_context=dict(language_hints=[lang_hint[language]]),
-    )
+def ocr_cache_key(content_hash):
+    # Results depend on the backend and the upload preprocessing, Google
+    # Vision results of the original images are keyed by the hash only
+    key = content_hash
+    if g_ocr_backend != "google":
+        key += f":{g_ocr_backend}"
+    if g_ocr_max_height:
+        key += f":gray-jpeg-h{g_ocr_max_height}-q{g_ocr_jpeg_quality}"
+    return key
 
+def convert_text_annotation(annotation, BreakType):
     paragraphs = []
 
-    BreakType = vision.TextAnnotation.DetectedBreak.BreakType
-
-    for page in response.full_text_annotation.pages:
+    for page in annotation.pages:
         for block in page.blocks:
             for paragraph in block.paragraphs:
                 p_text = ""
@@ -168,26 +179,175 @@ def detect_page_ocr(path, language):
                 p_para["text"] = p_text
                 paragraphs.append(p_para)
 
-    if response.error.message:
-        raise Exception(
-            '{}\nFor more info on error messages, check: '
-            'https://cloud.google.com/apis/design/errors'.format(
-                response.error.message))
+    return paragraphs
 
-    result = {
+def read_ocr_image(path):
+    """Return the image to upload, its resolution and the original resolution
+
+    With `--ocr-max-height` large pages such as the upscaled ones are sent as
+    smaller grayscale JPEGs."""
+
+    with io.open(path, 'rb') as image_file:
+        content = image_file.read()
+
+    with Image.open(BytesIO(content)) as img:
+        resolution = img.size
+        if not g_ocr_max_height:
+            return content, resolution, resolution
+
+        scale = min(g_ocr_max_height / resolution[1], 1.0)
+        size = (max(round(resolution[0] * scale), 1), max(round(resolution[1] * scale), 1))
+        upload = img.convert("L")
+        if size != resolution:
+            upload = upload.resize(size, Image.LANCZOS)
+
+    data = BytesIO()
+    upload.save(data, format="JPEG", quality=g_ocr_jpeg_quality)
+    return data.getvalue(), size, resolution
+
+def scale_ocr_aabbs(paragraphs, scale_x, scale_y):
+    for paragraph in paragraphs:
+        for item in itertools.chain([paragraph], paragraph["words"], paragraph["symbols"]):
+            aabb = item["aabb"]
+            aabb["min"] = (round(aabb["min"][0] * scale_x), round(aabb["min"][1] * scale_y))
+            aabb["max"] = (round(aabb["max"][0] * scale_x), round(aabb["max"][1] * scale_y))
+
+def ocr_result(path, language, annotation, upload_resolution, resolution):
+    paragraphs = convert_text_annotation(annotation, ocr_backend.break_type)
+
+    # Boxes are in the coordinates of the uploaded image
+    if upload_resolution != resolution:
+        scale_ocr_aabbs(paragraphs,
+            resolution[0] / upload_resolution[0], resolution[1] / upload_resolution[1])
+
+    return {
         "source": path,
         "language": language,
         "paragraphs": paragraphs,
         "resolution": resolution,
     }
 
-    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-    with open_ex(tmp_path, "wt", encoding="utf-8") as f:
-        json.dump(result, f, indent=1, ensure_ascii=False)
+def detect_page_ocr(path, language):
+    """Detects document features in an image."""
+
+    cache_key = ocr_cache_key(ocr_cache.file_hash(path))
+    result = ocr_cache.get(cache_key)
+    if result is not None:
+        return result
+
+    log(f".. Processing OCR: {path} ({language})")
 
-    with open_ex(tmp_path, "rb") as f:
-        return json.load(f)
+    content, upload_resolution, resolution = read_ocr_image(path)
+    annotation = ocr_backend.detect(path, content, language, upload_resolution)
+    result = ocr_result(path, language, annotation, upload_resolution, resolution)
+
+    ocr_cache.put(cache_key, result)
+    return result
 
+# Retries of a failed OCR batch, waiting `OCR_RETRY_DELAY * 2**n` seconds
+OCR_RETRIES = 4
+OCR_RETRY_DELAY = 2.0
+# Google Cloud Vision rejects requests with more images
+OCR_MAX_BATCH = 16
+
+def detect_ocr_batch(items):
+    """Annotate `(path, language)` items with one request, runs in a thread
+
+    Returns the result of each item or the exception of the items that the
+    service failed to annotate."""
+    batch = []
+    resolutions = []
+    for path, language in items:
+        content, upload_resolution, resolution = read_ocr_image(path)
+        batch.append((path, content, language, upload_resolution))
+        resolutions.append(resolution)
+    annotations = ocr_backend.detect_batch(batch)
+    results = []
+    for (path, _, language, upload_resolution), annotation, resolution in zip(batch, annotations, resolutions):
+        if not isinstance(annotation, Exception):
+            annotation = ocr_result(path, language, annotation, upload_resolution, resolution)
+        results.append(annotation)
+    return results
+
+def plan_ocr_stage(tasks):
+    """Split `tasks` to ones that are ready and ones waiting for OCR
+
+    Returns the ready tasks, the waiting tasks and the cache keys they need
+    by page index and the `(path, language)` of each missing key."""
+
+    ready = []
+    page_keys = { }
+    images = { }
+    for task in tasks:
+        keys = set()
+        if task.page.get("ocr", True):
+            for path, language in zip(page_task_images(task), ("jp", "en")):
+                if not path: continue
+                key = ocr_cache_key(ocr_cache.file_hash(path))
+                if key in images or not ocr_cache.contains(key):
+                    images.setdefault(key, (path, language))
+                    keys.add(key)
+        if keys:
+            page_keys[task.index] = (task, keys)
+        else:
+            ready.append(task)
+    return ready, page_keys, images
+
+async def ocr_stage(page_keys, images, submit, concurrency, batch_size):
+    """OCR the images planned by `plan_ocr_stage()` before the CPU heavy part
+
+    Requests of `batch_size` images run in threads, at most `concurrency` at
+    a time. Each page is passed to `submit()` as soon as its images are in
+    `ocr_cache`. Pages whose OCR fails are submitted anyway so that the
+    worker retries and reports the error."""
+
+    if not images: return
+    log(f"OCR stage: {len(images)} images in batches of {batch_size}, {concurrency} in flight")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    def finish(keys):
+        for index, (task, pending) in list(page_keys.items()):
+            pending -= keys
+            if not pending:
+                del page_keys[index]
+                submit(task)
+
+    async def run_batch(keys):
+        async with semaphore:
+            # Only the images that failed are retried
+            for attempt in range(OCR_RETRIES + 1):
+                try:
+                    results = await loop.run_in_executor(None, detect_ocr_batch, [images[k] for k in keys])
+                except Exception as e:
+                    results = [e] * len(keys)
+
+                # The cache connection belongs to the event loop thread
+                failed = []
+                for key, result in zip(keys, results):
+                    if isinstance(result, Exception):
+                        failed.append((key, result))
+                    else:
+                        ocr_cache.put(key, result)
+                        log(f".. Processed OCR: {images[key][0]}")
+                finish(set(keys) - set(k for k, _ in failed))
+                if not failed: return
+
+                keys = [k for k, _ in failed]
+                error = failed[0][1]
+                if attempt == OCR_RETRIES:
+                    log(f"OCR failed: {', '.join(images[k][0] for k in keys)}: {error}")
+                    finish(set(keys))
+                    return
+                delay = OCR_RETRY_DELAY * 2 ** attempt
+                log(f"OCR failed for {len(keys)} images, retrying in {delay:.0f}s: {error}")
+                await asyncio.sleep(delay)
+
+    keys = list(images)
+    await asyncio.gather(*(run_batch(keys[i:i + batch_size]) for i in range(0, len(keys), batch_size)))
+
+# Keep in sync with `PRIORITY_SCORES` in jdict_gen/generate_jdict.py
 prio_score = {
     "news1": 3,
     "ichi1": 3,
@@ -198,11 +358,24 @@ prio_score = {
     "nf03": 2,
 }
 
+def priority_score(priority):
+    return max((prio_score.get(p, 1) for p in priority), default=0)
+
+# Scores of every priority combination in the dictionary, filled in `initialize()`
+info_scores = { }
+
+def info_score(info):
+    priority = tuple(info.priority)
+    score = info_scores.get(priority)
+    if score is None:
+        score = info_scores[priority] = priority_score(priority)
+    return score
+
 def format_info(text, info, primary):
     return {
         "text": text,
         "primary": primary,
-        "score": max((prio_score.get(p, 1) for p in info.priority), default=0),
+        "score": info_score(info),
         "info": info.info,
     }
 
@@ -232,6 +405,47 @@ def format_result(result):
         "conjugation": format_conjugation(result),
     }
 
+class FormatCache:
+    """Bounded LRU of formatted results sorted by score, keyed by query string
+
+    Lookup results only depend on the query so common words are formatted
+    once per process. The cached dicts are shared between hints and must not
+    be modified. `results` are only consumed on a miss so they can be a lazy
+    `JDict.lookup_top()`, with `max_results` only the best ones are kept."""
+
+    __slots__ = ("max_size", "max_results", "entries", "hits", "misses")
+
+    def __init__(self, max_size, max_results=0):
+        self.max_size = max_size
+        self.max_results = max_results
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def format(self, query, results):
+        formatted = self.entries.get(query)
+        if formatted is not None:
+            self.hits += 1
+            self.entries.move_to_end(query)
+            return formatted
+
+        self.misses += 1
+        formatted = tuple(sorted((format_result(r) for r in results), key=lambda x: x["score"], reverse=True))
+        if self.max_results > 0:
+            formatted = formatted[:self.max_results]
+        if self.max_size > 0:
+            self.entries[query] = formatted
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return formatted
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), {len(self.entries)} entries"
+
+format_cache = FormatCache(0)
+
 def loose_intersects(a, b, factor):
     a_min = a["min"]
     a_max = a["max"]
@@ -254,24 +468,54 @@ def loose_intersects(a, b, factor):
     return delta_x < extent_x * factor and delta_y < extent_y * factor
 
 def cluster_page_paragraphs(page):
+    """Group the paragraphs that `loose_intersects()` each other directly or
+    through other paragraphs of the group
+
+    Candidate pairs come from a sweep over the loosened boxes sorted by their
+    left edge so only boxes overlapping horizontally are tested, the groups
+    are merged with union-find. Clusters are ordered by their last paragraph
+    descending, each starting with its last paragraph followed by the rest
+    in order."""
+
     paragraphs = page["paragraphs"]
-    unassigned = list(range(len(paragraphs)))
-    clusters = []
+    parents = list(range(len(paragraphs)))
+    factor = 1.25
+
+    def find(ix):
+        while parents[ix] != ix:
+            parents[ix] = parents[parents[ix]]
+            ix = parents[ix]
+        return ix
+
+    spans = []
+    for ix, paragraph in enumerate(paragraphs):
+        aabb = paragraph["aabb"]
+        center = (aabb["min"][0] + aabb["max"][0]) * 0.5
+        extent = (aabb["max"][0] - aabb["min"][0]) * 0.5 * factor
+        spans.append((center - extent, center + extent, ix))
+    spans.sort()
+
+    # Candidates are kept with some slack, `loose_intersects()` decides
+    slack = 1e-6 * max((abs(v) for lo, hi, _ in spans for v in (lo, hi)), default=0.0)
+
+    active = []
+    for lo, hi, ix in spans:
+        active = [(a_hi, a_ix) for a_hi, a_ix in active if a_hi > lo - slack]
+        aabb = paragraphs[ix]["aabb"]
+        for _, other_ix in active:
+            if loose_intersects(aabb, paragraphs[other_ix]["aabb"], factor):
+                root, other_root = find(ix), find(other_ix)
+                if root != other_root:
+                    parents[min(root, other_root)] = max(root, other_root)
+        active.append((hi, ix))
+
+    groups = { }
+    for ix in range(len(paragraphs)):
+        groups.setdefault(find(ix), []).append(ix)
 
-    while unassigned:
-        cluster = [unassigned.pop()]
-        while True:
-            for add_ix in unassigned:
-                for self_ix in cluster:
-                    add_aabb = paragraphs[add_ix]["aabb"]
-                    self_aabb = paragraphs[self_ix]["aabb"]
-                    if loose_intersects(add_aabb, self_aabb, 1.25):
-                        cluster.append(add_ix)
-                        unassigned.remove(add_ix)
-                        break
-            else:
-                break
-        clusters.append({ "paragraphs": cluster, "translation": "" })
+    clusters = []
+    for group in sorted(groups.values(), key=lambda g: g[-1], reverse=True):
+        clusters.append({ "paragraphs": group[-1:] + group[:-1], "translation": "" })
 
     for cluster in clusters:
         c_para = [paragraphs[ix] for ix in cluster["paragraphs"]]
@@ -286,19 +530,34 @@ def paragraph_mid_y(paragraph):
     aabb = paragraph["aabb"]
     return (aabb["min"][1] + aabb["max"][1]) * 0.5
 
-def normalize_aabb(aabb, resolution):
-    return {
-        "min": (aabb["min"][0] / resolution[1], aabb["min"][1] / resolution[1]),
-        "max": (aabb["max"][0] / resolution[1], aabb["max"][1] / resolution[1]),
-    }
+def normalize_aabbs(page):
+    """Paragraph boxes of `page` as `(min_x, min_y, max_x, max_y)` rows
+    relative to the page height"""
+    aabbs = np.array([(*p["aabb"]["min"], *p["aabb"]["max"]) for p in page["paragraphs"]], dtype=np.float64)
+    return aabbs.reshape(-1, 4) / page["resolution"][1]
 
-def transform_aabb(aabb, transform):
+def transform_aabbs(aabbs, transform):
     scale = transform["scale"]
     offset = transform["offset"]
-    return {
-        "min": ((aabb["min"][0] + offset[0]) * scale[0], (aabb["min"][1] + offset[1]) * scale[1]),
-        "max": ((aabb["max"][0] + offset[0]) * scale[0], (aabb["max"][1] + offset[1]) * scale[1]),
-    }
+    return (aabbs + np.tile(offset, 2)) * np.tile(scale, 2)
+
+def loose_intersects_matrix(a, b, factor):
+    """`loose_intersects()` of every row of `a` against every row of `b`"""
+    a_center = (a[:, :2] + a[:, 2:]) * 0.5
+    a_extent = (a[:, 2:] - a[:, :2]) * 0.5
+    b_center = (b[:, :2] + b[:, 2:]) * 0.5
+    b_extent = (b[:, 2:] - b[:, :2]) * 0.5
+
+    delta = np.abs(b_center[np.newaxis, :, :] - a_center[:, np.newaxis, :])
+    extent = a_extent[:, np.newaxis, :] + b_extent[np.newaxis, :, :]
+    return np.all(delta < extent * factor, axis=2)
+
+def cluster_membership(clusters, num_paragraphs):
+    """Matrix with a row per cluster that is 1 for its paragraphs"""
+    membership = np.zeros((len(clusters), num_paragraphs), dtype=np.int32)
+    for cluster_ix, cluster in enumerate(clusters):
+        membership[cluster_ix, cluster["paragraphs"]] = 1
+    return membership
 
 def capitalize_nonword(m):
     text = m.group(1)
@@ -318,21 +577,21 @@ def cleanup_translation(text):
     return text
 
 def add_cluster_translations(page_jp, page_en, en_transform):
-    for cluster_jp in page_jp["clusters"]:
-        en_paragraphs = []
+    jp_aabbs = normalize_aabbs(page_jp)
+    en_aabbs = transform_aabbs(normalize_aabbs(page_en), en_transform)
 
-        for cluster_en in page_en["clusters"]:
-            for jp_ix, en_ix in itertools.product(cluster_jp["paragraphs"], cluster_en["paragraphs"]):
-                jp_aabb = normalize_aabb(page_jp["paragraphs"][jp_ix]["aabb"], page_jp["resolution"])
-                en_aabb = normalize_aabb(page_en["paragraphs"][en_ix]["aabb"], page_en["resolution"])
-                en_aabb = transform_aabb(en_aabb, en_transform)
-                if loose_intersects(jp_aabb, en_aabb, 1.2):
-                    break
-            else:
-                continue
-            for en_ix in cluster_en["paragraphs"]:
+    # Clusters match if any of their paragraphs do
+    intersects = loose_intersects_matrix(jp_aabbs, en_aabbs, 1.2).astype(np.int32)
+    jp_membership = cluster_membership(page_jp["clusters"], len(jp_aabbs))
+    en_membership = cluster_membership(page_en["clusters"], len(en_aabbs))
+    matches = jp_membership @ intersects @ en_membership.T > 0
+
+    for cluster_jp, cluster_matches in zip(page_jp["clusters"], matches):
+        en_paragraphs = []
+        for en_cluster_ix in np.flatnonzero(cluster_matches):
+            for en_ix in page_en["clusters"][en_cluster_ix]["paragraphs"]:
                 en_paragraphs.append(page_en["paragraphs"][en_ix])
-        
+
         en_paragraphs = sorted(en_paragraphs, key=paragraph_mid_y)
         trans = " ".join(p["text"] for p in en_paragraphs)
         cluster_jp["translation"] = cleanup_translation(trans)
@@ -422,25 +681,45 @@ def wk_body_text(text):
 
     return result if result else None
 
+# Hints are built once per subject and conjugation and shared like the
+# `FormatCache` results, they must not be modified
+wk_hints = { }
+
+def wk_hint(id, conjugation):
+    """WaniKani hint of subject `id`, radicals are referenced by subject id
+    and their images collected to `wk_radicals`"""
+    key = (id, conjugation)
+    hint = wk_hints.get(key)
+    if hint is not None: return hint
+
+    data = wk_subjects[id]
+    text = data["characters"]
+    radical_ids = data.get("component_subject_ids", [])
+    for radical_id in radical_ids:
+        if radical_id not in wk_radicals:
+            wk_radicals[radical_id] = wk_radical(radical_id)
+
+    hint = wk_hints[key] = {
+        "query": text,
+        "kanji": [{ "text": text, "primary": True, "score": 1, "info": [] }],
+        "kana": [wk_kana(r) for r in data["readings"]],
+        "gloss": [m["meaning"].lower() for m in data["meanings"]],
+        "score": 1,
+        "conjugation": conjugation,
+        "radicals": list(radical_ids),
+        "wk_meaning_mnemonic": wk_body_text(data.get("meaning_mnemonic", "")),
+        "wk_meaning_hint": wk_body_text(data.get("meaning_hint", "")),
+        "wk_reading_mnemonic": wk_body_text(data.get("reading_mnemonic", "")),
+        "wk_reading_hint": wk_body_text(data.get("reading_hint", "")),
+    }
+    return hint
+
 def get_extra_hints(text, results):
     hints = []
 
-    wk_kanji = wk_kanjis.get(text)
-    if wk_kanji:
-        hint = {
-            "query": text,
-            "kanji": [{ "text": text, "primary": True, "score": 1, "info": [] }],
-            "kana": [wk_kana(r) for r in wk_kanji["readings"]],
-            "gloss": [m["meaning"].lower() for m in wk_kanji["meanings"]],
-            "score": 1,
-            "conjugation": "",
-            "radicals": [wk_radical(id) for id in wk_kanji["component_subject_ids"]],
-            "wk_meaning_mnemonic": wk_body_text(wk_kanji.get("meaning_mnemonic", "")),
-            "wk_meaning_hint": wk_body_text(wk_kanji.get("meaning_hint", "")),
-            "wk_reading_mnemonic": wk_body_text(wk_kanji.get("reading_mnemonic", "")),
-            "wk_reading_hint": wk_body_text(wk_kanji.get("reading_hint", "")),
-        }
-        hints.append(hint)
+    kanji_id = wk_kanjis.get(text)
+    if kanji_id is not None:
+        hints.append(wk_hint(kanji_id, ""))
 
     options = { text: "" }
     for result in results:
@@ -449,110 +728,323 @@ def get_extra_hints(text, results):
             options[kanji] = format_conjugation(result)
 
     for opt, conjugation in options.items():
-        for wk_vocab in wk_vocabs.get(opt, []):
-            hint = {
-                "query": opt,
-                "kanji": [{ "text": opt, "primary": True, "score": 1, "info": [] }],
-                "kana": [wk_kana(r) for r in wk_vocab["readings"]],
-                "gloss": [m["meaning"].lower() for m in wk_vocab["meanings"]],
-                "score": 1,
-                "conjugation": conjugation,
-                "radicals": [wk_radical(id) for id in wk_vocab.get("component_subject_ids", [])],
-                "wk_meaning_mnemonic": wk_body_text(wk_vocab.get("meaning_mnemonic", "")),
-                "wk_meaning_hint": wk_body_text(wk_vocab.get("meaning_hint", "")),
-                "wk_reading_mnemonic": wk_body_text(wk_vocab.get("reading_mnemonic", "")),
-                "wk_reading_hint": wk_body_text(wk_vocab.get("reading_hint", "")),
-            }
-            hints.append(hint)
+        for vocab_id in wk_vocabs.get(opt, []):
+            hints.append(wk_hint(vocab_id, conjugation))
 
     return hints
 
-def add_hints_to_paragraph(paragraph):
-    text = paragraph["text"]
-    symbols = paragraph["symbols"]
-
-    hints = []
+# Path costs of the lattice segmentation, words cost less the higher their
+# priority score so the best path prefers few common words over rare ones
+# and any word over leaving symbols unmatched
+LATTICE_WORD_COST = 6
+LATTICE_FUZZY_COST = 8
+LATTICE_UNKNOWN_COST = 10
+
+def fuzzy_segment(text, symbols, sym_begin, max_sym_end):
+    """Longest `Segment` starting at `sym_begin` that has fuzzy matches, if any"""
+    text_begin = symbols[sym_begin]["begin"]
+    if not g_fuzzy or not is_japanese(text[text_begin]): return None
+
+    # Likely an OCR misread, retry the longest segment allowing one wrong character
+    for sym_end in range(max_sym_end - 1, sym_begin + 1, -1):
+        segment = text[text_begin:symbols[sym_end - 1]["end"]]
+        # Short kana segments are within one edit of too many words
+        folded = jdict.fold(segment)[0]
+        if len(folded) < 3 and not any(is_kanji(ch) for ch in folded): continue
+        result = list(jdict.lookup_fuzzy(segment))
+        if result:
+            return Segment(sym_begin, sym_end, segment, result, True)
+    return None
+
+def greedy_segments(text, symbols, sym_matches):
+    """Segment the paragraph taking the longest match of at most 9 symbols"""
+    segments = []
 
     sym_begin = 0
     length = len(symbols)
     while sym_begin < length:
-        best_result = None
-        best_sym_end = sym_begin + 1
-        best_segment = None
+        best = None
 
-        for sym_end in range(sym_begin + 1, min(sym_begin + 10, length + 1)):
-            text_begin = symbols[sym_begin]["begin"]
-            text_end = symbols[sym_end - 1]["end"]
+        text_begin = symbols[sym_begin]["begin"]
+        max_sym_end = min(sym_begin + 10, length + 1)
+        matches = sym_matches[sym_begin]
 
-            segment = text[text_begin:text_end]
-            result = list(jdict.lookup(segment))
+        for sym_end in range(sym_begin + 1, max_sym_end):
+            text_end = symbols[sym_end - 1]["end"]
+            result = matches.get(text_end)
             if result:
-                best_result = result
-                best_sym_end = sym_end
-                best_segment = segment
+                best = Segment(sym_begin, sym_end, text[text_begin:text_end], result, False)
 
-        if best_result:
-            extra = get_extra_hints(best_segment, best_result)
+        if not best:
+            best = fuzzy_segment(text, symbols, sym_begin, max_sym_end)
+        if not best:
+            best = Segment(sym_begin, sym_begin + 1, text[text_begin:symbols[sym_begin]["end"]], None, False)
+
+        segments.append(best)
+        sym_begin = best.end
+
+    return segments
+
+def lattice_segments(text, symbols, sym_matches, end_syms):
+    """Segment the paragraph by the cheapest path through the word lattice
+
+    Every match is an edge between symbol boundaries costing
+    `LATTICE_WORD_COST` minus the best priority score of its results and
+    every symbol can be skipped for `LATTICE_UNKNOWN_COST`. Boundaries are
+    relaxed in order so the work is linear in the number of matches."""
+
+    length = len(symbols)
+    costs = [0] + [None] * length
+    back = [None] * (length + 1)
+
+    def relax(segment, cost):
+        cost += costs[segment.begin]
+        if costs[segment.end] is None or cost < costs[segment.end]:
+            costs[segment.end] = cost
+            back[segment.end] = segment
+
+    for sym_begin in range(length):
+        text_begin = symbols[sym_begin]["begin"]
+        matched = False
+        for text_end, result in sym_matches[sym_begin].items():
+            score = max(info_score(r.info) for r in result)
+            for sym_end in end_syms.get(text_end, ()):
+                if sym_end <= sym_begin: continue
+                relax(Segment(sym_begin, sym_end, text[text_begin:text_end], result, False), LATTICE_WORD_COST - score)
+                matched = True
+
+        if not matched:
+            fuzzy = fuzzy_segment(text, symbols, sym_begin, min(sym_begin + 10, length + 1))
+            if fuzzy:
+                score = max(info_score(r.info) for r in fuzzy.results)
+                relax(fuzzy, LATTICE_FUZZY_COST - score)
+
+        unknown = Segment(sym_begin, sym_begin + 1, text[text_begin:symbols[sym_begin]["end"]], None, False)
+        relax(unknown, LATTICE_UNKNOWN_COST)
+
+    segments = []
+    sym_end = length
+    while sym_end > 0:
+        segments.append(back[sym_end])
+        sym_end = back[sym_end].begin
+    segments.reverse()
+    return segments
+
+def paragraph_matches(text, symbols):
+    """One dictionary walk per symbol shared by the segmentation and alt hints,
+    `end_syms` maps text offsets to the symbol indices ending there + 1"""
+    sym_matches = [jdict.prefix_matches(text, symbol["begin"], folded=True) for symbol in symbols]
+    end_syms = { }
+    for sym_ix, symbol in enumerate(symbols):
+        end_syms.setdefault(symbol["end"], []).append(sym_ix + 1)
+    return sym_matches, end_syms
+
+def alt_hint_spans(text, symbols, sym_matches, end_syms):
+    """Yield `(sym_begin, sym_end, segment, results)` for the symbol spans
+    that can have alt hints, `segment` is the folded text of the span
+
+    Only spans with dictionary matches or WaniKani subjects can have hints
+    so instead of trying every span the ends are collected from the matches
+    and by following `wk_prefixes`."""
+
+    # `norm_offsets` maps offsets in `text` to offsets in `norm_text`
+    norm_text, norm_offsets = jdict.fold(text)
+    length = len(symbols)
+
+    for sym_begin in range(length):
+        text_begin = symbols[sym_begin]["begin"]
+        norm_begin = norm_offsets[text_begin]
+        matches = sym_matches[sym_begin]
+
+        sym_ends = { sym_begin }
+        for text_end in matches:
+            sym_ends.update(e for e in end_syms.get(text_end, ()) if sym_begin < e < length)
+        for sym_end in range(sym_begin + 1, length):
+            segment = norm_text[norm_begin:norm_offsets[symbols[sym_end - 1]["end"]]]
+            if segment and segment not in wk_prefixes: break
+            sym_ends.add(sym_end)
+
+        for sym_end in sorted(sym_ends):
+            text_end = symbols[sym_end - 1]["end"]
+            segment = norm_text[norm_begin:norm_offsets[text_end]]
+            yield sym_begin, sym_end, segment, matches.get(text_end, [])
+
+def add_hints_to_paragraph(paragraph, volume_spans=None):
+    text = paragraph["text"]
+    symbols = paragraph["symbols"]
+
+    sym_matches, end_syms = paragraph_matches(text, symbols)
+
+    if g_segmentation == "lattice":
+        segments = lattice_segments(text, symbols, sym_matches, end_syms)
+    else:
+        segments = greedy_segments(text, symbols, sym_matches)
+
+    hints = []
+    for segment in segments:
+        if segment.results:
+            extra = get_extra_hints(segment.text, segment.results)
+            cache_key = ("fuzzy", segment.text) if segment.fuzzy else segment.text
+            results = segment.results
+            if g_max_results > 0 and not segment.fuzzy:
+                results = jdict.lookup_top(segment.text, g_max_results, folded=True)
             hint = {
-                "begin": sym_begin,
-                "end": best_sym_end,
-                "results": extra + sorted((format_result(r) for r in best_result), key=lambda x: x["score"], reverse=True),
+                "begin": segment.begin,
+                "end": segment.end,
+                "results": extra + list(format_cache.format(cache_key, results)),
             }
+            if segment.fuzzy:
+                hint["fuzzy"] = True
             hints.append(hint)
         else:
-            text_begin = symbols[sym_begin]["begin"]
-            text_end = symbols[sym_begin]["end"]
-            segment = text[text_begin:text_end]
-            extra = get_extra_hints(segment, [])
+            extra = get_extra_hints(segment.text, [])
             if extra:
                 hint = {
-                    "begin": sym_begin,
-                    "end": sym_begin + 1,
+                    "begin": segment.begin,
+                    "end": segment.end,
                     "results": extra,
                 }
                 hints.append(hint)
 
-        sym_begin = best_sym_end
-
     alt_hints = []
-    for sym_begin in range(length):
-        for sym_end in range(sym_begin, length):
-            text_begin = symbols[sym_begin]["begin"]
-            text_end = symbols[sym_end - 1]["end"]
-            segment = text[text_begin:text_end]
-            segment = re.sub(r"\s+", "", segment)
-            segment = segment.translate(KATAKANA_TO_HIRAGANA)
-            if len(segment) > 1 or (len(segment) == 1 and segment[0] not in HIRAGANA):
-                result = list(jdict.lookup(segment))
-                extra = get_extra_hints(segment, result)
-                if result:
-                    hint = {
-                        "begin": sym_begin,
-                        "end": sym_end,
-                        "results": extra + sorted((format_result(r) for r in result), key=lambda x: x["score"], reverse=True),
-                    }
-                    alt_hints.append(hint)
-                elif extra:
-                    hint = {
-                        "begin": sym_begin,
-                        "end": sym_end,
-                        "results": extra,
-                    }
-                    alt_hints.append(hint)
+    if g_alt_hints:
+        for sym_begin, sym_end, segment, results in alt_hint_spans(text, symbols, sym_matches, end_syms):
+            hint = make_alt_hint(sym_begin, sym_end, segment, results)
+            if hint:
+                alt_hints.append(hint)
+
+    if volume_spans is not None:
+        add_volume_spans(volume_spans, text, symbols, sym_matches, end_syms)
 
     paragraph["hints"] = hints
     paragraph["alt_hints"] = alt_hints
 
-def add_hints_to_page(page):
+def make_alt_hint(sym_begin, sym_end, segment, result):
+    """Alt hint for the folded `segment` with lookup results `result`, None if empty"""
+    if not (len(segment) > 1 or (len(segment) == 1 and segment[0] not in HIRAGANA)):
+        return None
+
+    extra = get_extra_hints(segment, result)
+    if result:
+        if g_max_results > 0:
+            result = jdict.lookup_top(segment, g_max_results, folded=True)
+        return {
+            "begin": sym_begin,
+            "end": sym_end,
+            "results": extra + list(format_cache.format(segment, result)),
+        }
+    elif extra:
+        return {
+            "begin": sym_begin,
+            "end": sym_end,
+            "results": extra,
+        }
+    return None
+
+def get_alt_hint(paragraph, sym_begin, sym_end):
+    """Alt hint of the symbols `sym_begin:sym_end` of `paragraph` computed on
+    demand the same way as in `add_hints_to_paragraph()`, None if empty"""
+    text = paragraph["text"]
+    symbols = paragraph["symbols"]
+    norm_text, norm_offsets = jdict.fold(text)
+    text_begin = symbols[sym_begin]["begin"]
+    text_end = symbols[sym_end - 1]["end"]
+    segment = norm_text[norm_offsets[text_begin]:norm_offsets[text_end]]
+    matches = jdict.prefix_matches(text, text_begin, text_end, folded=True)
+    return make_alt_hint(sym_begin, sym_end, segment, matches.get(text_end, []))
+
+def add_hints_to_page(page, volume_spans=None):
+    for paragraph in page["paragraphs"]:
+        add_hints_to_paragraph(paragraph, volume_spans)
+
+def add_volume_spans(spans, text, symbols, sym_matches, end_syms):
+    """Add the alt hint results of the symbol spans of a paragraph to `spans`
+    keyed by the text of the span, spans already in `spans` are kept"""
+    for sym_begin, sym_end, segment, results in alt_hint_spans(text, symbols, sym_matches, end_syms):
+        if sym_end <= sym_begin: continue
+        span = text[symbols[sym_begin]["begin"]:symbols[sym_end - 1]["end"]]
+        if span in spans: continue
+        hint = make_alt_hint(sym_begin, sym_end, segment, results)
+        if hint:
+            spans[span] = hint["results"]
+
+def load_volume_spans(path):
+    """Span results of a page written by an earlier run, see `add_volume_spans()`"""
+    spans = { }
+    for paragraph in load_page_paragraphs(path):
+        text = paragraph["text"]
+        symbols = paragraph["symbols"]
+        sym_matches, end_syms = paragraph_matches(text, symbols)
+        add_volume_spans(spans, text, symbols, sym_matches, end_syms)
+    return spans
+
+class EntryTable:
+    """Formatted results stored once and referred to by index
+
+    The same words show up in many overlapping hints. Formatted results are
+    shared objects so most are deduplicated by identity before comparing
+    the serialized result."""
+
+    __slots__ = ("entries", "entry_ids", "object_ids")
+
+    def __init__(self):
+        self.entries = []
+        self.entry_ids = { }
+        self.object_ids = { }
+
+    def index(self, result):
+        # Keeps a reference to `result` so that its id is not reused
+        _, ix = self.object_ids.get(id(result), (None, None))
+        if ix is None:
+            key = json.dumps(result, sort_keys=True, ensure_ascii=False)
+            ix = self.entry_ids.get(key)
+            if ix is None:
+                ix = self.entry_ids[key] = len(self.entries)
+                self.entries.append(result)
+            self.object_ids[id(result)] = (result, ix)
+        return ix
+
+def share_page_entries(page):
+    """Move the hint results of `page` to a shared `entries` table"""
+
+    table = EntryTable()
     for paragraph in page["paragraphs"]:
-        add_hints_to_paragraph(paragraph)
+        for hint in itertools.chain(paragraph["hints"], paragraph["alt_hints"]):
+            hint["results"] = [table.index(r) for r in hint["results"]]
+
+    page["entries"] = table.entries
+
+def build_volume_dict(page_spans):
+    """Merge the span results of each page in `page_spans` into one volume
+
+    Replaces the per-page alt hints with one file per volume: `spans` maps
+    the text of each symbol span that has a hint to indices into the shared
+    `entries` table, the first page with the span wins. The viewer slices
+    the same text out of the paragraph, see `getVolumeDictHint()` in
+    web_viewer/main.js."""
+
+    table = EntryTable()
+    spans = { }
+    for page in page_spans:
+        for span, results in page.items():
+            if span not in spans:
+                spans[span] = [table.index(r) for r in results]
+
+    return {
+        "entries": table.entries,
+        "spans": spans,
+    }
 
 def process_page(jp_image, en_image, en_transform, dst_path, opts):
+    """Write the page files to `dst_path`, returns the span results of the
+    page with `--volume-dict`"""
     ocr = opts.get("ocr", True)
 
+    volume_spans = { } if g_volume_dict else None
     if ocr:
         jp_page = detect_page_ocr(jp_image, "jp")
-        add_hints_to_page(jp_page)
+        add_hints_to_page(jp_page, volume_spans)
+        share_page_entries(jp_page)
         cluster_page_paragraphs(jp_page)
 
         if en_image:
@@ -563,6 +1055,7 @@ def process_page(jp_image, en_image, en_transform, dst_path, opts):
         jp_page = {
             "paragraphs": jp_page["paragraphs"],
             "clusters": jp_page["clusters"],
+            "entries": jp_page["entries"],
             "resolution": jp_page["resolution"],
         }
     else:
@@ -571,18 +1064,194 @@ def process_page(jp_image, en_image, en_transform, dst_path, opts):
         jp_page = {
             "paragraphs": [],
             "clusters": [],
+            "entries": [],
             "resolution": resolution,
         }
 
+    if wk_subjects:
+        jp_page["radicals_file"] = RADICALS_NAME
+
+    # Tells the viewer where to find the alt hints instead
+    if g_volume_dict:
+        jp_page["volume_dict"] = VOLUME_DICT_NAME
+    elif not g_alt_hints:
+        jp_page["on_demand_hints"] = True
+
     _, jp_ext = os.path.splitext(jp_image)
     dst_image = dst_path + jp_ext
     if not os.path.exists(dst_image) or os.stat(jp_image).st_mtime > os.stat(dst_image).st_mtime:
         log(f"Copying image: {jp_image} -> {dst_image}")
         shutil.copyfile(jp_image, dst_image)
 
+    # Files that the page JSON refers to are written first so that it never
+    # refers to a missing one
+    if g_split_hints:
+        jp_page, hints = split_page_hints(jp_page, os.path.basename(dst_path) + ".hints.json")
+        with open_ex(dst_path + ".hints.json", "wt", encoding="utf-8",
+                atomic_write=not g_unsafe_write) as f:
+            if g_page_format == "json":
+                json.dump(hints, f, indent=1, ensure_ascii=False)
+            else:
+                json.dump(hints, f, ensure_ascii=False, separators=(",", ":"))
+
+    if g_page_format == "json":
+        with open_ex(dst_path + ".json", "wt", encoding="utf-8",
+                atomic_write=not g_unsafe_write) as f:
+            json.dump(jp_page, f, indent=1, ensure_ascii=False)
+        return volume_spans
+
+    sidecar_name = None
+    if g_page_format == "binary":
+        sidecar_name = os.path.basename(dst_path) + ".bin"
+    jp_page, sidecar = compact_page(jp_page, sidecar_name)
+
+    if sidecar is not None:
+        with open_ex(dst_path + ".bin", "wb", atomic_write=not g_unsafe_write) as f:
+            f.write(sidecar)
     with open_ex(dst_path + ".json", "wt", encoding="utf-8",
             atomic_write=not g_unsafe_write) as f:
-        json.dump(jp_page, f, indent=1, ensure_ascii=False)
+        json.dump(jp_page, f, ensure_ascii=False, separators=(",", ":"))
+    return volume_spans
+
+# Bits of the packed breaks in compact pages, zero means no break
+BREAK_FLAGS = ("space", "newline", "hyphen", "sure", "prefix")
+HINT_FUZZY = 1
+
+def pack_break(br):
+    if not br: return 0
+    bits = 1
+    for n, flag in enumerate(BREAK_FLAGS):
+        if br[flag]:
+            bits |= 2 << n
+    return bits
+
+def flat_aabbs(items):
+    return [c for item in items for c in (*item["aabb"]["min"], *item["aabb"]["max"])]
+
+def flat_hints(hints):
+    values = []
+    for hint in hints:
+        flags = HINT_FUZZY if hint.get("fuzzy") else 0
+        values += (hint["begin"], hint["end"], flags, len(hint["results"]))
+        values += hint["results"]
+    return values
+
+def compact_page(page, sidecar_name=None):
+    """Return the columnar form of `page` and the optional sidecar data
+
+    Paragraphs, words and symbols are stored as parallel arrays with four
+    coordinates per bounding box and packed breaks, the words and symbols of
+    all paragraphs concatenated. Hints are flat `begin, end, flags, count,
+    entries...` runs. With `sidecar_name` the arrays are written into a
+    separate little-endian int32 buffer instead, see `decodeCompactPage()`
+    in web_viewer/main.js for the reader."""
+
+    paragraphs = page["paragraphs"]
+    words = [w for p in paragraphs for w in p["words"]]
+    symbols = [s for p in paragraphs for s in p["symbols"]]
+
+    arrays = {
+        "paragraph_aabb": flat_aabbs(paragraphs),
+        "paragraph_break": [pack_break(p["break"]) for p in paragraphs],
+        "paragraph_words": [len(p["words"]) for p in paragraphs],
+        "paragraph_symbols": [len(p["symbols"]) for p in paragraphs],
+        "paragraph_hints": [len(flat_hints(p["hints"])) for p in paragraphs],
+        "paragraph_alt_hints": [len(flat_hints(p["alt_hints"])) for p in paragraphs],
+        "word_begin": [w["begin"] for w in words],
+        "word_end": [w["end"] for w in words],
+        "word_aabb": flat_aabbs(words),
+        "word_break": [pack_break(w["break"]) for w in words],
+        "symbol_begin": [s["begin"] for s in symbols],
+        "symbol_end": [s["end"] for s in symbols],
+        "symbol_aabb": flat_aabbs(symbols),
+        "symbol_break": [pack_break(s["break"]) for s in symbols],
+        "hints": [v for p in paragraphs for v in flat_hints(p["hints"])],
+        "alt_hints": [v for p in paragraphs for v in flat_hints(p["alt_hints"])],
+    }
+
+    result = {
+        "format": "compact",
+        "resolution": page["resolution"],
+        "paragraph_text": [p["text"] for p in paragraphs],
+        # Symbols are single code points
+        "symbol_text": "".join(s["text"] for s in symbols),
+        "clusters": page["clusters"],
+        "entries": page["entries"],
+    }
+    for key in ("hints_file", "on_demand_hints", "volume_dict", "radicals_file"):
+        if key in page:
+            result[key] = page[key]
+
+    if not sidecar_name:
+        result.update(arrays)
+        return result, None
+
+    data = array("i")
+    layout = { }
+    for name, values in arrays.items():
+        layout[name] = (len(data) * data.itemsize, len(values))
+        data.extend(values)
+    if sys.byteorder != "little":
+        data.byteswap()
+    result["sidecar"] = { "path": sidecar_name, "arrays": layout }
+    return result, data.tobytes()
+
+def split_page_hints(page, hints_name):
+    """Return the geometry of `page` without hints and the hints separately
+
+    The viewer can show the page and select text before the hints file
+    `hints_name` has loaded. The hints file has the `entries` table and the
+    `hints` and `alt_hints` of each paragraph in order."""
+
+    hints = {
+        "entries": page["entries"],
+        "hints": [p["hints"] for p in page["paragraphs"]],
+        "alt_hints": [p["alt_hints"] for p in page["paragraphs"]],
+    }
+    geometry = dict(page)
+    geometry["paragraphs"] = [dict(p, hints=[], alt_hints=[]) for p in page["paragraphs"]]
+    geometry["entries"] = []
+    geometry["hints_file"] = hints_name
+    return geometry, hints
+
+def load_page_paragraphs(path):
+    """Return the text and symbol offsets of the paragraphs of a page JSON
+    written by `process_page()` in any `--page-format`"""
+
+    with open_ex(path, "rb") as f:
+        page = json.load(f)
+
+    if page.get("format") != "compact":
+        return [{
+            "text": p["text"],
+            "symbols": [{ "begin": s["begin"], "end": s["end"] } for s in p["symbols"]],
+        } for p in page["paragraphs"]]
+
+    arrays = page
+    sidecar = page.get("sidecar")
+    if sidecar:
+        with open_ex(os.path.join(os.path.dirname(path), sidecar["path"]), "rb") as f:
+            data = f.read()
+        arrays = { }
+        for name in ("paragraph_symbols", "symbol_begin", "symbol_end"):
+            offset, count = sidecar["arrays"][name]
+            values = array("i")
+            values.frombytes(data[offset:offset + count * values.itemsize])
+            if sys.byteorder != "little":
+                values.byteswap()
+            arrays[name] = values
+
+    paragraphs = []
+    base = 0
+    for text, count in zip(page["paragraph_text"], arrays["paragraph_symbols"]):
+        begins = arrays["symbol_begin"][base:base + count]
+        ends = arrays["symbol_end"][base:base + count]
+        paragraphs.append({
+            "text": text,
+            "symbols": [{ "begin": b, "end": e } for b, e in zip(begins, ends)],
+        })
+        base += count
+    return paragraphs
 
 def replace_bracketed_number(text, offset):
     def inner(m):
@@ -607,14 +1276,72 @@ def expand_pages(desc):
             new_pages.append(new_page)
     desc["pages"] = new_pages
 
-def initialize(args):
+def load_jdict(path, lookup_cache_size, max_results=0):
     global jdict
+    global format_cache
+    global g_max_results
+
+    jdict = JDict(path, cache_size=lookup_cache_size)
+    log(f"Loaded {len(jdict.words)} Japanese words")
+
+    for info in jdict.infos:
+        priority = tuple(info.priority)
+        info_scores[priority] = priority_score(priority)
+    format_cache = FormatCache(lookup_cache_size, max_results)
+    g_max_results = max_results
+
+def load_wanikani(path):
+    with open_ex(path, "rb") as f:
+        wanikani_subjects = json.load(f)["subjects"]
+        log(f"Loaded {len(wanikani_subjects)} WaniKani subjects")
+        for subject in wanikani_subjects:
+            data = subject["data"]
+            wk_subjects[subject["id"]] = data
+            if subject["object"] == "kanji":
+                wk_kanjis[data["characters"]] = subject["id"]
+            elif subject["object"] == "vocabulary":
+                wk_vocabs.setdefault(data["characters"], []).append(subject["id"])
+            else:
+                continue
+            characters = data["characters"]
+            wk_prefixes.update(characters[:n] for n in range(1, len(characters) + 1))
+
+def configure_ocr(args):
+    """OCR settings that the main process needs before `initialize()`"""
+    global g_ocr_backend
+    global g_ocr_max_height
+    global g_ocr_jpeg_quality
+    global ocr_cache
+
+    g_ocr_backend = args.ocr_backend
+    g_ocr_max_height = args.ocr_max_height
+    g_ocr_jpeg_quality = args.ocr_jpeg_quality
+
+    if not ocr_cache:
+        ocr_cache = OcrCache(args.ocr_cache, OCR_LEGACY_DIR)
+
+def initialize(args):
     global g_unsafe_write
+    global g_fuzzy
+    global g_segmentation
+    global g_page_format
+    global g_split_hints
+    global g_alt_hints
+    global g_volume_dict
+    global g_initialized
+    global ocr_backend
 
     g_unsafe_write = args.unsafe_write
+    g_fuzzy = not args.no_fuzzy
+    g_segmentation = args.segmentation
+    g_page_format = args.page_format
+    g_split_hints = args.split_hints
+    g_alt_hints = not (args.no_alt_hints or args.volume_dict)
+    g_volume_dict = args.volume_dict
 
-    jdict = JDict(args.jdict)
-    log(f"Loaded {len(jdict.words)} Japanese words")
+    configure_ocr(args)
+
+    load_jdict(args.jdict, args.lookup_cache_size, args.max_results)
 
     uppercase = set(string.ascii_uppercase)
     for pat in itertools.chain(*args.en_dicts):
@@ -630,44 +1357,122 @@ def initialize(args):
         log(f"Loaded {len(en_words)} English words")
 
     if args.wanikani:
-        with open_ex(args.wanikani, "rb") as f:
-            wanikani_subjects = json.load(f)["subjects"]
-            log(f"Loaded {len(wanikani_subjects)} WaniKani subjects")
-            for subject in wanikani_subjects:
-                data = subject["data"]
-                wk_subjects[subject["id"]] = data
-                if subject["object"] == "kanji":
-                    wk_kanjis[data["characters"]] = data
-                elif subject["object"] == "vocabulary":
-                    wk_vocabs.setdefault(data["characters"], []).append(data)
+        load_wanikani(args.wanikani)
+
+    if args.ocr_backend == "offline":
+        ocr_backend = OfflineBackend(args.ocr_fixtures, {
+            "jp": offline_jp_words(),
+            "en": sorted(en_words),
+        })
+    else:
+        ocr_backend = GoogleVisionBackend()
+
+    g_initialized = True
+
+def memory_stats():
+    """Resident memory of this process, the shared part of forked workers is
+    what they still share with the main process and the other workers"""
+    try:
+        fields = { }
+        with open("/proc/self/smaps_rollup", "rt") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if value.strip().endswith("kB"):
+                    fields[name] = int(value.split()[0]) * 1024
+        shared = fields["Shared_Clean"] + fields["Shared_Dirty"]
+        return f"RSS {fields['Rss']/1e6:.1f}MB ({shared/1e6:.1f}MB shared)"
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin": peak *= 1024
+        return f"peak RSS {peak/1e6:.1f}MB"
+    except ImportError:
+        return "RSS unknown"
+
+def initialize_worker(args, pool_start):
+    """Pool initializer, forked workers inherit the dictionaries loaded by the
+    main process and only need to load them when spawned"""
+    global log_name
+    log_name = None
+    if not g_initialized:
+        initialize(args)
+    log(f"Worker started in {time.time() - pool_start:.2f}s, {memory_stats()}")
+
+def offline_jp_words(count=20000):
+    """Vocabulary of `OfflineBackend`, the first spelling of the first words
+    of the dictionary"""
+    words = []
+    for index in range(min(count, len(jdict.words))):
+        word = jdict.words[index]
+        words.append((word["kanji"] or word["kana"])[0][0])
+    return words
+
+def page_task_images(page_task):
+    """Paths of the Japanese and English (or empty) images of `page_task`"""
+    page = page_task.page
+    desc_base = page_task.desc.path
+    jp_page = os.path.join(desc_base, page.get("jp", ""))
+    en_page = page.get("en", "")
+    if en_page: en_page = os.path.join(desc_base, en_page)
+    return jp_page, en_page
+
+def prefetch_ocr(tasks):
+    """Load the cached OCR results of the pages of `tasks` at once"""
+    keys = []
+    for task in tasks:
+        if not task.page.get("ocr", True): continue
+        keys += [ocr_cache_key(ocr_cache.file_hash(p)) for p in page_task_images(task) if p]
+    found = ocr_cache.prefetch(keys)
+    log(f"OCR cache: {found}/{len(keys)} images cached")
 
 def process_page_task(page_task):
     page = page_task.page
     index = page_task.index
     path = page_task.path
     num_pages = page_task.desc.num_pages
-    desc_base = page_task.desc.path
 
     log(f"Processing page {index+1}/{num_pages}")
     dst_path = os.path.join(path, f"page{index+1:03d}")
-    jp_page = os.path.join(desc_base, page.get("jp", ""))
-    en_page = page.get("en", "")
-    if en_page: en_page = os.path.join(desc_base, en_page)
+    jp_page, en_page = page_task_images(page_task)
     en_transform = page.get("transform", { "scale": (1,1), "offset": (0,0) })
-    process_page(jp_page, en_page, en_transform, dst_path, page)
+    radical_ids = set(wk_radicals)
+    volume_spans = process_page(jp_page, en_page, en_transform, dst_path, page)
+    log(f"Lookup cache: {format_cache.stats()}")
+    log(f"OCR cache: {ocr_cache.stats()}")
+    log(f"Memory: {memory_stats()}")
 
-    return page_task
+    # The main process merges the radicals first used by this page and the
+    # span results into the volume dictionary
+    new_radicals = { id: r for id, r in wk_radicals.items() if id not in radical_ids }
+    return page_task, new_radicals, volume_spans
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert pages to a Mango-readable form")
     parser.add_argument("desc", metavar="desc.json", help="Description file")
     parser.add_argument("-o", metavar="out-dir/", help="Output path")
     parser.add_argument("--range", metavar="begin:end", help="Process a range of pages")
-    parser.add_argument("--jdict", help="Japanese dictionary .json")
+    parser.add_argument("--jdict", help="Japanese dictionary .bin or .json")
     parser.add_argument("--en-dicts", nargs="+", action="append", help="English word list files")
     parser.add_argument("--wanikani", help="Wanikani subject file")
     parser.add_argument("--threads", type=int, default=1, help="Number of threads to use")
+    parser.add_argument("--lookup-cache-size", type=int, default=16384, help="Number of cached dictionary lookups per process")
     parser.add_argument("--unsafe-write", action="store_true", help="Write results unsafely")
+    parser.add_argument("--ocr-cache", default=os.path.join("temp", "ocr.sqlite"), help="OCR result cache file")
+    parser.add_argument("--ocr-backend", choices=["google", "offline"], default="google", help="OCR service, offline makes up deterministic text for testing and benchmarks")
+    parser.add_argument("--ocr-concurrency", type=int, default=8, help="Number of OCR requests in flight, 0 to OCR in the page workers instead")
+    parser.add_argument("--ocr-batch", type=int, default=4, help=f"Number of images per OCR request (max {OCR_MAX_BATCH})")
+    parser.add_argument("--ocr-max-height", type=int, default=0, help="Upload pages as grayscale JPEGs of at most this height, boxes are scaled back (0 = original image)")
+    parser.add_argument("--ocr-jpeg-quality", type=int, default=90, help="JPEG quality of --ocr-max-height uploads")
+    parser.add_argument("--ocr-fixtures", metavar="dir/", help="Directory of <image name>.<jp|en>.json text fixtures for --ocr-backend offline")
+    parser.add_argument("--max-results", type=int, default=0, help="Keep only the best N dictionary results per hint (default: all)")
+    parser.add_argument("--segmentation", choices=["greedy", "lattice"], default="greedy", help="Primary hint segmentation: longest match or best path by priority (default: greedy)")
+    parser.add_argument("--page-format", choices=["json", "compact", "binary"], default="json", help="Page metadata format: indented JSON, columnar minified JSON or columnar JSON with a binary sidecar (default: json)")
+    parser.add_argument("--split-hints", action="store_true", help="Write the hints of each page to a separate file that the viewer loads later")
+    parser.add_argument("--no-alt-hints", action="store_true", help="Skip alt hints, the viewer asks mango_server.py --jdict for them on demand")
+    parser.add_argument("--volume-dict", action="store_true", help=f"Skip alt hints, write the results of every span of the volume to {VOLUME_DICT_NAME} instead")
+    parser.add_argument("--no-fuzzy", action="store_true", help="Don't look up unmatched text allowing for OCR errors")
     parser.add_argument("--info-only", action="store_true", help="Only generate info and cover")
     parser.add_argument("--gcp-credentials", help="Google GCP credentials")
 
@@ -677,7 +1482,7 @@ if __name__ == "__main__":
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = args.gcp_credentials
 
     if not args.jdict:
-        for opt in ["data/jdict.json.gz", "data/jdict.json"]:
+        for opt in ["data/jdict.bin", "data/jdict.json.gz", "data/jdict.json"]:
             if os.path.exists(opt):
                 log(f"Autodetected: --jdict {opt}")
                 args.jdict = opt
@@ -698,6 +1503,9 @@ if __name__ == "__main__":
                 break
     
     args.threads = min(args.threads, 60)
+    if not 1 <= args.ocr_batch <= OCR_MAX_BATCH:
+        args.ocr_batch = max(1, min(args.ocr_batch, OCR_MAX_BATCH))
+        log(f"Clamped --ocr-batch to {args.ocr_batch}")
 
     os.makedirs(args.o, exist_ok=True)
 
@@ -775,16 +1583,82 @@ if __name__ == "__main__":
             if not (begin <= index <= end): continue
             tasks.append(PageTask(args.o, page, index, desc_task))
 
+    configure_ocr(args)
+    prefetch_ocr(tasks)
+
+    # Images missing from the cache are OCR'd by this process while the
+    # workers process the pages that are ready
+    ready_tasks, page_keys, ocr_images = tasks, { }, { }
+    if args.ocr_concurrency > 0:
+        ready_tasks, page_keys, ocr_images = plan_ocr_stage(tasks)
+
+    radicals = { }
+    page_spans = { }
+    finished_pages = 0
+    def page_done(result):
+        global finished_pages
+        task, new_radicals, volume_spans = result
+        radicals.update(new_radicals)
+        if volume_spans is not None:
+            page_spans[task.index] = volume_spans
+        finished_pages += 1
+        prog = finished_pages / task.desc.num_pages * 100
+        log(f"Finished page {task.index+1}/{task.desc.num_pages} <{prog:.1f}%>")
+
+    # Loaded once here, forked workers share the dictionaries copy-on-write
+    init_start = time.time()
+    initialize(args)
+    log(f"Initialized in {time.time() - init_start:.2f}s, {memory_stats()}")
+
     if args.threads > 1:
-        with multiprocessing.Pool(args.threads, initialize, (args,)) as pool:
-            ordered_index = 0
-            for task in pool.imap_unordered(process_page_task, tasks):
-                ordered_index += 1
-                prog = ordered_index / task.desc.num_pages * 100
-                log(f"Finished page {task.index+1}/{task.desc.num_pages} <{prog:.1f}%>")
+        # Spawned workers (no fork on Windows) load everything themselves
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        else:
+            context = multiprocessing.get_context()
+
+        # Keep the collector from touching (and so copying) the inherited objects
+        if hasattr(gc, "freeze"): gc.freeze()
+        with context.Pool(args.threads, initialize_worker, (args, time.time())) as pool:
+            results = []
+            def submit(task):
+                results.append(pool.apply_async(process_page_task, (task,), callback=page_done))
+
+            for task in ready_tasks:
+                submit(task)
+            asyncio.run(ocr_stage(page_keys, ocr_images, submit, args.ocr_concurrency, args.ocr_batch))
+            for result in results:
+                result.get()
+        if hasattr(gc, "unfreeze"): gc.unfreeze()
     else:
-        initialize(args)
+        asyncio.run(ocr_stage(page_keys, ocr_images, lambda task: None, args.ocr_concurrency, args.ocr_batch))
         for task in tasks:
-            process_page_task(task)
-            prog = (task.index+1) / task.desc.num_pages * 100
-            log(f"Finished page {task.index+1}/{task.desc.num_pages} <{prog:.1f}%>")
+            page_done(process_page_task(task))
+
+    if args.volume_dict:
+        # Covers the pages of earlier `--range` runs too, those are read back
+        def volume_page_spans():
+            for index in range(len(pages)):
+                page_path = os.path.join(args.o, f"page{index+1:03d}.json")
+                if index in page_spans:
+                    yield page_spans[index]
+                elif os.path.exists(page_path):
+                    yield load_volume_spans(page_path)
+        volume_dict = build_volume_dict(volume_page_spans())
+        with open_ex(os.path.join(args.o, VOLUME_DICT_NAME), "wt", encoding="utf-8",
+                atomic_write=not args.unsafe_write) as f:
+            json.dump(volume_dict, f, ensure_ascii=False, separators=(",", ":"))
+        log(f"Wrote {len(volume_dict['spans'])} spans and {len(volume_dict['entries'])} entries to {VOLUME_DICT_NAME}")
+
+    # Merged into the existing sheet so that it covers earlier `--range` runs too
+    if args.wanikani:
+        radicals.update(wk_radicals)
+        radicals_path = os.path.join(args.o, RADICALS_NAME)
+        sheet = { }
+        if os.path.exists(radicals_path):
+            with open_ex(radicals_path, "rt", encoding="utf-8") as f:
+                sheet = json.load(f)
+        sheet.update((str(id), radical) for id, radical in radicals.items())
+        with open_ex(radicals_path, "wt", encoding="utf-8", atomic_write=not args.unsafe_write) as f:
+            json.dump(sheet, f, ensure_ascii=False, separators=(",", ":"))
+        log(f"Wrote {len(sheet)} radicals to {RADICALS_NAME}")
@@ -0,0 +1,219 @@
+import os
+import json
+import enum
+import random
+import hashlib
+from collections import namedtuple
+from PIL import Image
+
+# Backends return the `full_text_annotation` of a Google Cloud Vision
+# response or the same structure built from these
+Vertex = namedtuple("Vertex", "x y")
+BoundingPoly = namedtuple("BoundingPoly", "vertices")
+DetectedBreak = namedtuple("DetectedBreak", "type_ is_prefix")
+TextProperty = namedtuple("TextProperty", "detected_break")
+Symbol = namedtuple("Symbol", "text bounding_box property")
+Word = namedtuple("Word", "symbols bounding_box property")
+Paragraph = namedtuple("Paragraph", "words bounding_box property")
+Block = namedtuple("Block", "paragraphs")
+Page = namedtuple("Page", "blocks")
+TextAnnotation = namedtuple("TextAnnotation", "pages")
+
+class BreakType(enum.IntEnum):
+    """Same values as `vision.TextAnnotation.DetectedBreak.BreakType`"""
+    UNKNOWN = 0
+    SPACE = 1
+    SURE_SPACE = 2
+    EOL_SURE_SPACE = 3
+    HYPHEN = 4
+    LINE_BREAK = 5
+
+lang_hint = {
+    "jp": "ja-Jpan",
+    "en": "en-t-i0-handwrit",
+}
+
+class GoogleVisionBackend:
+    """Document text detection with Google Cloud Vision"""
+
+    name = "google"
+
+    def __init__(self):
+        self.client = None
+
+    @property
+    def break_type(self):
+        from google.cloud import vision
+        return vision.TextAnnotation.DetectedBreak.BreakType
+
+    def detect(self, path, content, language, resolution):
+        from google.cloud import vision
+        if not self.client:
+            self.client = vision.ImageAnnotatorClient()
+
+        response = self.client.document_text_detection(
+            image=vision.Image(content=content),
+            image_context=dict(language_hints=[lang_hint[language]]),
+        )
+
+        if response.error.message:
+            raise Exception(
+                '{}\nFor more info on error messages, check: '
+                'https://cloud.google.com/apis/design/errors'.format(
+                    response.error.message))
+
+        return response.full_text_annotation
+
+    def detect_batch(self, items):
+        """Annotations of `(path, content, language, resolution)` items with
+        one request, at most 16 items per request
+
+        Items that failed get an exception instead so that the rest of the
+        batch is not lost."""
+        from google.cloud import vision
+        if not self.client:
+            self.client = vision.ImageAnnotatorClient()
+
+        feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+        response = self.client.batch_annotate_images(requests=[
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=[feature],
+                image_context=vision.ImageContext(language_hints=[lang_hint[language]]),
+            ) for path, content, language, resolution in items])
+
+        annotations = []
+        for (path, *_), r in zip(items, response.responses):
+            if r.error.message:
+                annotations.append(Exception(f"{path}: {r.error.message}\nFor more info on error messages, check: "
+                    "https://cloud.google.com/apis/design/errors"))
+            else:
+                annotations.append(r.full_text_annotation)
+        return annotations
+
+def _rect(x0, y0, x1, y1):
+    return BoundingPoly([Vertex(x0, y0), Vertex(x1, y0), Vertex(x1, y1), Vertex(x0, y1)])
+
+def _union(boxes):
+    vertices = [v for b in boxes for v in b.vertices]
+    return _rect(min(v.x for v in vertices), min(v.y for v in vertices),
+        max(v.x for v in vertices), max(v.y for v in vertices))
+
+def _property(btype):
+    return TextProperty(DetectedBreak(btype, False) if btype else None)
+
+def _scale_box(box, scale_x, scale_y):
+    return BoundingPoly([Vertex(round(v.x * scale_x), round(v.y * scale_y)) for v in box.vertices])
+
+def scale_paragraph(paragraph, scale_x, scale_y):
+    """Copy of `paragraph` with every bounding box scaled"""
+    words = []
+    for word in paragraph.words:
+        symbols = [s._replace(bounding_box=_scale_box(s.bounding_box, scale_x, scale_y)) for s in word.symbols]
+        words.append(word._replace(symbols=symbols, bounding_box=_scale_box(word.bounding_box, scale_x, scale_y)))
+    return paragraph._replace(words=words, bounding_box=_scale_box(paragraph.bounding_box, scale_x, scale_y))
+
+def layout_paragraph(words, aabb, vertical, separator):
+    """Lay out the symbols of `words` in rows or right-to-left columns that
+    fill `aabb` as a `Paragraph`, `separator` is the break between words"""
+    x0, y0, x1, y1 = aabb
+    count = max(sum(len(w) for w in words), 1)
+    along, across = (y1 - y0, x1 - x0) if vertical else (x1 - x0, y1 - y0)
+    size = max(int((along * across / count) ** 0.5), 1)
+    per_line = max(along // size, 1)
+
+    index = 0
+    p_words = []
+    for word_ix, word in enumerate(words):
+        symbols = []
+        for ch_ix, ch in enumerate(word):
+            line, pos = divmod(index, per_line)
+            if vertical:
+                sx, sy = x1 - (line + 1) * size, y0 + pos * size
+            else:
+                sx, sy = x0 + pos * size, y0 + line * size
+            index += 1
+
+            btype = None
+            if word_ix == len(words) - 1 and ch_ix == len(word) - 1:
+                btype = BreakType.LINE_BREAK
+            elif pos == per_line - 1:
+                btype = BreakType.LINE_BREAK
+            elif ch_ix == len(word) - 1:
+                btype = separator
+            symbols.append(Symbol(ch, _rect(sx, sy, sx + size, sy + size), _property(btype)))
+        if symbols:
+            p_words.append(Word(symbols, _union(s.bounding_box for s in symbols), _property(None)))
+
+    return Paragraph(p_words, _union(w.bounding_box for w in p_words), _property(None))
+
+class OfflineBackend:
+    """Deterministic stand-in that needs no network access
+
+    Pages with a fixture `<fixture_dir>/<image name>.<language>.json` like
+    `{"paragraphs": [{"text": "...", "aabb": [x0, y0, x1, y1]}]}` get that
+    text, words separated by whitespace and Japanese laid out vertically.
+    Fixture boxes are in the pixels of the original image, the annotation is
+    scaled to the uploaded `resolution` like the real service would return.
+    Other pages get paragraphs of words from `vocabulary[language]` seeded
+    by the image contents, so repeated runs produce the same results."""
+
+    name = "offline"
+    break_type = BreakType
+
+    def __init__(self, fixture_dir=None, vocabulary=None):
+        self.fixture_dir = fixture_dir
+        self.vocabulary = vocabulary or { }
+
+    def detect(self, path, content, language, resolution):
+        vertical = language == "jp"
+        separator = None if vertical else BreakType.SPACE
+
+        fixture = self.load_fixture(path, language)
+        if fixture is not None:
+            paragraphs = [layout_paragraph(p["text"].split(), p["aabb"], p.get("vertical", vertical), separator)
+                for p in fixture["paragraphs"] if p["text"].strip()]
+            with Image.open(path) as img:
+                size = img.size
+            if size != tuple(resolution):
+                scale_x, scale_y = resolution[0] / size[0], resolution[1] / size[1]
+                paragraphs = [scale_paragraph(p, scale_x, scale_y) for p in paragraphs]
+        else:
+            paragraphs = self.synthesize(content, language, resolution, vertical, separator)
+
+        return TextAnnotation([Page([Block([p]) for p in paragraphs])])
+
+    def detect_batch(self, items):
+        annotations = []
+        for item in items:
+            try:
+                annotations.append(self.detect(*item))
+            except Exception as e:
+                annotations.append(e)
+        return annotations
+
+    def load_fixture(self, path, language):
+        if not self.fixture_dir: return None
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            with open(os.path.join(self.fixture_dir, f"{name}.{language}.json"), "rt", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def synthesize(self, content, language, resolution, vertical, separator):
+        words = self.vocabulary.get(language)
+        if not words:
+            words = ["あ", "い", "う"] if vertical else ["lorem", "ipsum", "dolor"]
+
+        rng = random.Random(hashlib.sha256(content).digest())
+        width, height = resolution
+        paragraphs = []
+        for _ in range(rng.randint(3, 10)):
+            p_words = [rng.choice(words) for _ in range(rng.randint(1, 8))]
+            w = rng.randint(width // 20, width // 4) + 1
+            h = rng.randint(height // 20, height // 4) + 1
+            x = rng.randint(0, max(width - w, 0))
+            y = rng.randint(0, max(height - h, 0))
+            paragraphs.append(layout_paragraph(p_words, (x, y, x + w, y + h), vertical, separator))
+        return paragraphs
@@ -0,0 +1,116 @@
+import os
+import json
+import gzip
+import zlib
+import sqlite3
+import hashlib
+
+_schema = """
+create table if not exists results (key text primary key, data blob not null);
+create table if not exists files (path text primary key, size integer not null, mtime_ns integer not null, hash text not null);
+"""
+
+class OcrCache:
+    """OCR results stored in a single SQLite file keyed by image content
+
+    Results are stored as zlib compressed JSON under the SHA-256 of the image
+    plus an optional suffix for anything else that affects the result. The
+    hashes are memoized by (path, size, mtime) so unchanged images are never
+    read again. Results of the older one-file-per-image cache in `legacy_dir`
+    are moved into the store as they are used.
+
+    The connection is reopened in forked processes, results loaded with
+    `prefetch()` before forking are shared with the children."""
+
+    def __init__(self, path, legacy_dir=None):
+        self.path = path
+        self.legacy_dir = legacy_dir
+        self.pid = None
+        self.db = None
+        self.prefetched = { }
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        if self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=60)
+            self.db.execute("pragma journal_mode=wal")
+            self.db.executescript(_schema)
+            self.pid = os.getpid()
+        return self.db
+
+    def file_hash(self, path):
+        """SHA-256 of the contents of `path`, only read if it has changed"""
+        db = self.connect()
+        st = os.stat(path)
+        path = os.path.abspath(path)
+        row = db.execute("select size, mtime_ns, hash from files where path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+
+        with open(path, "rb") as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        with db:
+            db.execute("insert or replace into files values (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, content_hash))
+        return content_hash
+
+    def get(self, key):
+        """Cached result for `key` or None"""
+        result = self.prefetched.pop(key, None)
+        if result is None:
+            db = self.connect()
+            row = db.execute("select data from results where key = ?", (key,)).fetchone()
+            if row:
+                result = json.loads(zlib.decompress(row[0]))
+            else:
+                result = self.load_legacy(key)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def contains(self, key):
+        if key in self.prefetched: return True
+        db = self.connect()
+        if db.execute("select 1 from results where key = ?", (key,)).fetchone(): return True
+        return bool(self.legacy_dir) and os.path.exists(os.path.join(self.legacy_dir, f"{key}.json.gz"))
+
+    def put(self, key, result):
+        data = zlib.compress(json.dumps(result, ensure_ascii=False).encode("utf-8"))
+        db = self.connect()
+        with db:
+            db.execute("insert or replace into results values (?, ?)", (key, data))
+
+    def load_legacy(self, key):
+        if not self.legacy_dir: return None
+        try:
+            with gzip.open(os.path.join(self.legacy_dir, f"{key}.json.gz"), "rb") as f:
+                result = json.load(f)
+        except FileNotFoundError:
+            return None
+        self.put(key, result)
+        return result
+
+    def prefetch(self, keys):
+        """Load the results of `keys` with one query, returns the number found
+
+        Prefetched results are handed out once by `get()`."""
+        db = self.connect()
+        keys = list(keys)
+        found = 0
+        for base in range(0, len(keys), 500):
+            chunk = keys[base:base + 500]
+            query = "select key, data from results where key in ({})".format(",".join("?" * len(chunk)))
+            for key, data in db.execute(query, chunk):
+                self.prefetched[key] = json.loads(zlib.decompress(data))
+                found += 1
+        return found
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
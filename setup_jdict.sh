@@ -13,4 +13,4 @@ fi
 
 mkdir -p data
 curl http://ftp.edrdg.org/pub/Nihongo/JMdict_e.gz -o data/JMDict_e.gz
-$MANGO_PYTHON jdict_gen/generate_jdict.py --jmdict-path data/JMDict_e.gz --conj-table-path jdict_gen/tables -o data/jdict.json.gz
+$MANGO_PYTHON jdict_gen/generate_jdict.py --jmdict-path data/JMDict_e.gz --conj-table-path jdict_gen/tables -o data/jdict.bin
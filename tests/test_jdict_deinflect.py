@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "jdict_gen"))
+import conj
+import generate_jdict
+from jdict import JDict
+
+TABLES = os.path.join(ROOT, "jdict_gen", "tables")
+
+# (kanji, kana, part-of-speech, gloss)
+WORDS = [
+    ("食べる", "たべる", "Ichidan verb", "to eat"),
+    ("見る", "みる", "Ichidan verb", "to see"),
+    ("書く", "かく", "Godan verb with 'ku' ending", "to write"),
+    ("読む", "よむ", "Godan verb with 'mu' ending", "to read"),
+    ("行く", "いく", "Godan verb - Iku/Yuku special class", "to go"),
+    ("来る", "くる", "Kuru verb - special class", "to come"),
+    ("高い", "たかい", "adjective (keiyoushi)", "high"),
+    (None, "する", "suru verb - included", "to do"),
+    ("勉強", "べんきょう", "noun (common) (futsuumeishi)", "study"),
+    ("切手", "きって", "noun (common) (futsuumeishi)", "stamp"),
+]
+
+def write_jmdict(path):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', "<JMdict>"]
+    for kanji, kana, pos, gloss in WORDS:
+        lines.append("<entry>")
+        if kanji:
+            lines.append(f"<k_ele><keb>{kanji}</keb></k_ele>")
+        lines.append(f"<r_ele><reb>{kana}</reb></r_ele>")
+        lines.append(f"<sense><pos>{pos}</pos><gloss>{gloss}</gloss></sense>")
+        lines.append("</entry>")
+    lines.append("</JMdict>")
+    with open(path, "wt", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+def conjugations(text, position):
+    """`(form, conj, neg, fml)` of every conjugation of `text` like the
+    dictionary used to store them"""
+    ct = generate_jdict.ct
+    pos = ct["kwpos"][position][0]
+    for (p, conj2, neg, fml, onum), row in ct["conjo"].items():
+        if p != pos or len(text) < 2: continue
+        _, _, _, _, _, stem, okuri, euphr, euphk, _ = row
+        yield conj.construct(text, stem, okuri, euphr, euphk), conj2, neg, fml
+
+class DeinflectTest(unittest.TestCase):
+    """`lookup()` with rules gives the results of the pre-expanded dictionary
+    that stored every conjugated form as a key"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        jmdict = os.path.join(cls.dir, "JMdict_e.xml")
+        write_jmdict(jmdict)
+        generate_jdict.load_conj_tables(TABLES)
+        result = generate_jdict.generate(jmdict, TABLES, 1)
+        path = os.path.join(cls.dir, "jdict.json")
+        with open(path, "wt", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        cls.jdict = JDict(path)
+
+        ct = generate_jdict.ct
+        cls.conj_names = { c[0]: c[1] for c in ct["conj"].values() }
+        conj_ids = { name.split(" ")[0]: id for id, name in cls.conj_names.items() }
+
+        # Conjugated forms and te-forms of the words, other words ending in
+        # て or で must not be relabeled by the auxiliaries
+        cls.expanded = { }
+        te_forms = { }
+        for kanji, kana, pos, gloss in WORDS:
+            for text in filter(None, (kanji, kana)):
+                if text[-1] in "てで":
+                    te_forms.setdefault(text, set())
+                for form, conj2, neg, fml in conjugations(text, pos):
+                    cls.expanded.setdefault(form, set()).add((gloss, cls.conj_names[conj2], neg, fml))
+                    if conj2 == conj_ids["Conjunctive"] and not neg and not fml and form[-1] in "てで":
+                        te_forms.setdefault(form, set()).add(gloss)
+
+        # Te-forms followed by every conjugation of an auxiliary
+        cls.chained = { }
+        for aux, position, name, contracted in generate_jdict.auxiliaries:
+            for form, conj2, neg, fml in conjugations(aux, position):
+                if conj2 == conj_ids["Continuative"]: continue
+                if contracted: form = form[1:]
+                label = name if conj2 == conj_ids["Non-past"] else f"{name} {cls.conj_names[conj2]}"
+                for te, glosses in te_forms.items():
+                    expected = cls.chained.setdefault(te + form, set())
+                    expected.update((gloss, label, neg, fml) for gloss in glosses)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def results(self, query, chained):
+        """Conjugated results of `query` or the ones relabeled by an auxiliary"""
+        plain = set(self.jdict.conjugations)
+        if chained:
+            return set((r.word.gloss[0], r.conjugation, r.negative, r.formal)
+                for r in self.jdict.lookup(query) if r.conjugation not in plain)
+        return set((r.word.gloss[0], r.conjugation, r.negative, r.formal)
+            for r in self.jdict.lookup(query) if r.conjugated)
+
+    def test_plain_forms(self):
+        for form, expected in self.expanded.items():
+            if len(form) < 2: continue
+            with self.subTest(form=form):
+                self.assertEqual(self.results(form, False), expected)
+
+    def test_chained_forms(self):
+        for form, expected in self.chained.items():
+            with self.subTest(form=form):
+                self.assertEqual(self.results(form, True), expected)
+
+    def test_examples(self):
+        chained = self.results("食べていなかった", True)
+        self.assertIn(("to eat", "Progressive Past (~ta)", True, False), chained)
+        self.assertIn(("to read", "Progressive", False, False), self.results("読んでいる", True))
+        self.assertIn(("to read", "Progressive", False, False), self.results("読んでる", True))
+        # Only te-form results are relabeled, not words that happen to end in て
+        self.assertEqual(self.results("きっている", True), set())
+
+if __name__ == "__main__":
+    unittest.main()
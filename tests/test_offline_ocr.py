@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import mangofy
+from ocr_backends import OfflineBackend
+
+FIXTURE = {"paragraphs": [
+    {"text": "日本 語 です", "aabb": [100, 100, 200, 400]},
+    {"text": "猫が 好き", "aabb": [300, 120, 360, 500]},
+]}
+
+class OfflineFixtureTest(unittest.TestCase):
+    """Fixture boxes come back in the coordinates of the original image with
+    and without `--ocr-max-height`"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.dir, "001.png")
+        Image.new("RGB", (800, 1200), "white").save(self.image)
+        with open(os.path.join(self.dir, "001.jp.json"), "wt", encoding="utf-8") as f:
+            json.dump(FIXTURE, f, ensure_ascii=False)
+        mangofy.ocr_backend = OfflineBackend(self.dir)
+
+    def tearDown(self):
+        mangofy.g_ocr_max_height = 0
+        shutil.rmtree(self.dir)
+
+    def detect(self, max_height):
+        mangofy.g_ocr_max_height = max_height
+        content, upload_resolution, resolution = mangofy.read_ocr_image(self.image)
+        annotation = mangofy.ocr_backend.detect(self.image, content, "jp", upload_resolution)
+        return mangofy.ocr_result(self.image, "jp", annotation, upload_resolution, resolution)
+
+    def test_max_height_boxes_match_fixture(self):
+        original = self.detect(0)
+        scaled = self.detect(400)
+        self.assertEqual(scaled["resolution"], (800, 1200))
+        self.assertEqual(len(scaled["paragraphs"]), len(FIXTURE["paragraphs"]))
+
+        # Rounding in the 3x smaller upload moves the boxes by a few pixels
+        tolerance = 3
+        for fixture, a, b in zip(FIXTURE["paragraphs"], original["paragraphs"], scaled["paragraphs"]):
+            x0, y0, x1, y1 = fixture["aabb"]
+            self.assertLessEqual(abs(b["aabb"]["min"][0] - a["aabb"]["min"][0]), tolerance)
+            self.assertLessEqual(abs(b["aabb"]["min"][1] - y0), tolerance)
+            self.assertLessEqual(b["aabb"]["max"][0], x1 + tolerance)
+            self.assertLessEqual(b["aabb"]["max"][1], y1 + tolerance)
+            for sa, sb in zip(a["symbols"], b["symbols"]):
+                self.assertEqual(sa["text"], sb["text"])
+                for corner in ("min", "max"):
+                    for axis in range(2):
+                        self.assertLessEqual(abs(sa["aabb"][corner][axis] - sb["aabb"][corner][axis]), tolerance)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
 const { h, render, createState, useState, immutable } = kaiku
 
+// Radicals are subject ids into the radicals file of the volume, older pages
+// and mango_server.py hints have them inline
 function Radical({ radical }) {
+    if (typeof radical == "number") radical = topState.radicals[radical]
+    if (!radical) return null
     return h("div", { className: "radical" },
         h("img", { className: "radical-image", src: radical.image }),
         h("div", { className: "radical-text" }, radical.name)
@@ -171,6 +175,150 @@ function getAltHint(paragraph, symBegin, symEnd) {
     return null
 }
 
+// Pages built with `mangofy.py --volume-dict` look up the text of the span in
+// the volume dictionary, see `build_volume_dict()`
+function getVolumeDictHint(dict, paragraph, symBegin, symEnd) {
+    const symbols = paragraph.symbols
+    // Symbol offsets count code points like Python strings
+    const span = Array.from(paragraph.text).slice(symbols[symBegin].begin, symbols[symEnd - 1].end).join("")
+    if (!Object.hasOwn(dict.spans, span)) return null
+    return {
+        begin: symBegin,
+        end: symEnd,
+        results: dict.spans[span].map(ix => dict.entries[ix]),
+    }
+}
+
+// Must match `BREAK_FLAGS` and `HINT_FUZZY` in mangofy.py
+const breakFlags = ["space", "newline", "hyphen", "sure", "prefix"]
+const hintFuzzy = 1
+
+function unpackBreak(bits) {
+    if (!bits) return null
+    const br = { }
+    breakFlags.forEach((flag, n) => { br[flag] = (bits & (2 << n)) != 0 })
+    return br
+}
+
+function unpackAabb(values, index) {
+    const base = index * 4
+    return {
+        min: [values[base + 0], values[base + 1]],
+        max: [values[base + 2], values[base + 3]],
+    }
+}
+
+function unpackHints(values, begin, end) {
+    const hints = []
+    let pos = begin
+    while (pos < end) {
+        const count = values[pos + 3]
+        const hint = {
+            begin: values[pos + 0],
+            end: values[pos + 1],
+            results: Array.from(values.slice(pos + 4, pos + 4 + count)),
+        }
+        if (values[pos + 2] & hintFuzzy) hint.fuzzy = true
+        hints.push(hint)
+        pos += 4 + count
+    }
+    return hints
+}
+
+// Sidecar arrays are little-endian int32, as are typed arrays on the
+// platforms the viewer runs on
+function sidecarArrays(sidecar, buffer) {
+    const arrays = { }
+    for (const name in sidecar.arrays) {
+        const [offset, count] = sidecar.arrays[name]
+        arrays[name] = new Int32Array(buffer, offset, count)
+    }
+    return arrays
+}
+
+// Expand a page written by `compact_page()` in mangofy.py into the regular
+// page layout, `arrays` holds the columns either from the JSON or the sidecar
+function decodeCompactPage(page, arrays) {
+    const symbolText = Array.from(page.symbol_text)
+    const paragraphs = []
+    let wordIx = 0, symbolIx = 0, hintPos = 0, altHintPos = 0
+
+    page.paragraph_text.forEach((text, paraIx) => {
+        const words = []
+        const symbols = []
+        for (let i = 0; i < arrays.paragraph_words[paraIx]; i++, wordIx++) {
+            words.push({
+                begin: arrays.word_begin[wordIx],
+                end: arrays.word_end[wordIx],
+                aabb: unpackAabb(arrays.word_aabb, wordIx),
+                break: unpackBreak(arrays.word_break[wordIx]),
+            })
+        }
+        for (let i = 0; i < arrays.paragraph_symbols[paraIx]; i++, symbolIx++) {
+            symbols.push({
+                text: symbolText[symbolIx],
+                begin: arrays.symbol_begin[symbolIx],
+                end: arrays.symbol_end[symbolIx],
+                aabb: unpackAabb(arrays.symbol_aabb, symbolIx),
+                break: unpackBreak(arrays.symbol_break[symbolIx]),
+            })
+        }
+
+        const hintEnd = hintPos + arrays.paragraph_hints[paraIx]
+        const altHintEnd = altHintPos + arrays.paragraph_alt_hints[paraIx]
+        paragraphs.push({
+            text,
+            aabb: unpackAabb(arrays.paragraph_aabb, paraIx),
+            words,
+            symbols,
+            break: unpackBreak(arrays.paragraph_break[paraIx]),
+            hints: unpackHints(arrays.hints, hintPos, hintEnd),
+            alt_hints: unpackHints(arrays.alt_hints, altHintPos, altHintEnd),
+        })
+        hintPos = hintEnd
+        altHintPos = altHintEnd
+    })
+
+    return {
+        paragraphs,
+        clusters: page.clusters,
+        entries: page.entries,
+        resolution: page.resolution,
+        hints_file: page.hints_file,
+        on_demand_hints: page.on_demand_hints,
+        volume_dict: page.volume_dict,
+        radicals_file: page.radicals_file,
+    }
+}
+
+// Resolve the compact page format and its sidecar relative to the page URL
+function loadCompactPage(page, metaUrl) {
+    if (page.format != "compact") return page
+    if (!page.sidecar) return decodeCompactPage(page, page)
+
+    const url = new URL(page.sidecar.path, new URL(metaUrl, window.location.href))
+    return fetch(url)
+        .then(r => {
+            if (!r.ok) throw new Error(`Failed to load ${url}: ${r.status}`)
+            return r.arrayBuffer()
+        })
+        .then(buffer => decodeCompactPage(page, sidecarArrays(page.sidecar, buffer)))
+}
+
+// Hint results refer to the shared `page.entries` table by index, older
+// pages without the table have the results inline
+function resolvePageEntries(page) {
+    if (!page.entries) return
+    for (const paragraph of page.paragraphs) {
+        for (const hint of paragraph.hints) {
+            hint.results = hint.results.map(ix => page.entries[ix])
+        }
+        for (const hint of paragraph.alt_hints) {
+            hint.results = hint.results.map(ix => page.entries[ix])
+        }
+    }
+}
+
 function getClusterRects(page, cluster) {
     let rects = []
     for (const paraIx of cluster.paragraphs) {
@@ -249,6 +397,10 @@ class Top {
     skipClick = false
     dragTouchId = null
     dragTapSymbolIx = -1
+    volumeDictUrl = null
+    radicalsUrl = null
+    volumeDict = null
+    volumeHints = new Map()
 
     constructor() {
         const params = new URLSearchParams(window.location.search)
@@ -450,15 +602,7 @@ class Top {
 
             if (this.selection.symBegin != prevSelection.symBegin || this.selection.symEnd != prevSelection.symEnd) {
                 this.dragTapSymbolIx = -1
-                const hint = getAltHint(page.paragraphs[hit.paraIx], this.selection.symBegin, this.selection.symEnd)
-
-                if (hint != this.state.hint) {
-                    this.setState({
-                        hint: hint,
-                        hintId: (this.state.hintId + 1) % 4096,
-                        translation: "",
-                    })
-                }
+                this.showAltHint(page, hit.paraIx, this.selection.symBegin, this.selection.symEnd)
 
                 rootTarget = getSelectionTarget(page, this.selection)
                 updateHighlights(getSelectionRects(page, this.selection))
@@ -469,6 +613,55 @@ class Top {
         }
     }
 
+    showAltHint(page, paraIx, symBegin, symEnd) {
+        let hint = getAltHint(page.paragraphs[paraIx], symBegin, symEnd)
+        if (!hint && page.volume_dict && this.volumeDict) {
+            // Memoized so that the same selection keeps the same hint object
+            const key = `${paraIx}:${symBegin}:${symEnd}`
+            if (!this.volumeHints.has(key)) {
+                this.volumeHints.set(key, getVolumeDictHint(this.volumeDict, page.paragraphs[paraIx], symBegin, symEnd))
+            }
+            hint = this.volumeHints.get(key)
+        }
+        if (hint != this.state.hint) {
+            this.setState({
+                hint: hint,
+                hintId: (this.state.hintId + 1) % 4096,
+                translation: "",
+            })
+        }
+
+        if (!hint && page.on_demand_hints) {
+            this.loadAltHint(paraIx, symBegin, symEnd)
+        }
+    }
+
+    // Pages built with `mangofy.py --no-alt-hints` get them from mango_server.py
+    loadAltHint(paraIx, symBegin, symEnd) {
+        const token = this.loadToken
+        const params = new URLSearchParams({
+            page: this.lastGoodPage.meta,
+            paragraph: paraIx,
+            begin: symBegin,
+            end: symEnd,
+        })
+        fetch("/api/hints?" + params)
+            .then(r => r.json())
+            .then(hint => {
+                const selection = this.selection
+                if (token != this.loadToken || !hint || !selection) return
+                if (selection.paraIx != paraIx || selection.symBegin != symBegin || selection.symEnd != symEnd) return
+
+                this.setState({
+                    hint: hint,
+                    hintId: (this.state.hintId + 1) % 4096,
+                    translation: "",
+                })
+                updateRoot()
+            })
+            .catch(error => console.error("Failed to load hint", error))
+    }
+
     dragEnd() {
         const { page } = this.state
 
@@ -482,14 +675,7 @@ class Top {
                 symEnd: symIx + 1,
             }
 
-            const hint = getAltHint(page.paragraphs[this.selection.paraIx], symIx, symIx + 1)
-            if (hint != this.state.hint) {
-                this.setState({
-                    hint: hint,
-                    hintId: (this.state.hintId + 1) % 4096,
-                    translation: "",
-                })
-            }
+            this.showAltHint(page, this.selection.paraIx, symIx, symIx + 1)
 
             rootTarget = getSelectionTarget(page, this.selection)
             updateHighlights(getSelectionRects(page, this.selection))
@@ -586,10 +772,12 @@ class Top {
         this.setState({ page: null })
         this.selection = null
         this.dragSelection = null
+        this.volumeHints.clear()
 
         const token = ++this.loadToken
         fetch(pageInfo.meta)
             .then(r => r.json())
+            .then(page => loadCompactPage(page, pageInfo.meta))
             .then(page => this.onLoadMetadata(page, token, pageInfo))
             .catch(error => this.onLoadError(error))
     }
@@ -609,8 +797,74 @@ class Top {
             this.preloadImage.src = `/${this.doc}/page${indexStr}.jpg`
         }
 
+        resolvePageEntries(page)
+
         this.lastGoodPage = pageInfo
         this.state.page = immutable(page)
+
+        if (page.radicals_file) {
+            this.loadRadicals(new URL(page.radicals_file, new URL(pageInfo.meta, window.location.href)).href)
+        }
+
+        if (page.volume_dict) {
+            this.loadVolumeDict(new URL(page.volume_dict, new URL(pageInfo.meta, window.location.href)).href)
+        }
+
+        // Hints split into a separate file are loaded once the page is interactive
+        if (page.hints_file) {
+            const url = new URL(page.hints_file, new URL(pageInfo.meta, window.location.href))
+            fetch(url)
+                .then(r => r.json())
+                .then(hints => this.onLoadHints(page, hints, token))
+                .catch(error => console.error(`Failed to load hints ${url}`, error))
+        }
+    }
+
+    // The volume dictionary is shared by all pages so it's loaded only once
+    loadVolumeDict(url) {
+        if (this.volumeDictUrl == url) return
+        this.volumeDictUrl = url
+        this.volumeDict = null
+        fetch(url)
+            .then(r => r.json())
+            .then(dict => {
+                if (this.volumeDictUrl == url) this.volumeDict = dict
+            })
+            .catch(error => {
+                // Retried on the next page load
+                if (this.volumeDictUrl == url) this.volumeDictUrl = null
+                console.error(`Failed to load volume dictionary ${url}`, error)
+            })
+    }
+
+    loadRadicals(url) {
+        if (this.radicalsUrl == url) return
+        this.radicalsUrl = url
+        fetch(url)
+            .then(r => r.json())
+            .then(radicals => {
+                if (this.radicalsUrl == url) this.state.radicals = immutable(radicals)
+            })
+            .catch(error => {
+                if (this.radicalsUrl == url) this.radicalsUrl = null
+                console.error(`Failed to load radicals ${url}`, error)
+            })
+    }
+
+    onLoadHints(page, hints, token) {
+        if (token != this.loadToken) return
+
+        const withHints = {
+            ...page,
+            entries: hints.entries,
+            paragraphs: page.paragraphs.map((paragraph, ix) => ({
+                ...paragraph,
+                hints: hints.hints[ix],
+                alt_hints: hints.alt_hints[ix],
+            })),
+        }
+        resolvePageEntries(withHints)
+        this.state.page = immutable(withHints)
     }
 
     mount(root) {
@@ -651,6 +905,7 @@ const topState = createState({
     translation: "",
     style: { },
     highlightRects: [],
+    radicals: { },
 })
 
 function HighlightTop()